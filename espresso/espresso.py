@@ -198,15 +198,20 @@ class Espresso(Calculator):
                            'walltime': '50:00:00',
                            'nodes': 1,
                            'ppn': 1,
-                           'pools': 4, # Number k-points must be divisible by pools
+                           'pools': 'auto', # or the number of k-point pools
+                           'ndiag': None,
                            'processor':None,
                            'mem': None,
                            'jobname': None,
                            'queue': None,
                            'restart': False,
+                           'autorestart': 0, # Resubmissions allowed after max_seconds
+                           'walltime_buffer': 0.1, # Fraction of walltime kept free
+                           'pert_mode': 'serial', # or 'split' or 'array'
 			   'qsys': ESPRESSORC['qsys'],
 			   'mpicmd': ESPRESSORC['mpicmd'],
-			   'rundir': ESPRESSORC['rundir']}
+			   'rundir': ESPRESSORC['rundir'],
+                           'pseudo_stage': ESPRESSORC.get('pseudo_stage')}
 
         # Define a default folder for where the pseudopotentials are held
         if self.string_params['pseudo_dir'] == None:
@@ -260,6 +265,7 @@ class Espresso(Calculator):
             self.read_input()
             try:
                 self.read_output()
+                self.record_timing()
             except (IOError): # In case the job got submitted but never started
                 self.converged = False
                 pass
@@ -435,11 +441,16 @@ class Espresso(Calculator):
                                         '{0}'.format(itype),
                                         self.PPs[unique_atom[0]][0]))
             
+        # The valences are read from the pseudopotentials
+        valences = {}
+        for symbol in set(symbols):
+            valences[symbol] = self.get_valence(symbol)
+
         # Set nbands automatically if not set manually. We want to override the
         # default, which is 1.2 * the number of electrons. We want 1.5 times
         nbands = 0
         for atom in self.atoms:
-            nbands += self.PPs[atom.symbol][1]
+            nbands += valences[atom.symbol]
         self.int_params['nbnd'] = int(nbands * 1.5)
         self.old_int_params['nbnd'] = int(nbands * 1.5) # Backwards compatability
 
@@ -542,8 +553,12 @@ class Espresso(Calculator):
             raise EspressoRunning('Running', os.getcwd())
         if (self.status == 'done'
             and self.converged == False):
+            if (getattr(self, 'max_seconds_reached', False)
+                and self.get_number_of_restarts() < self.run_params['autorestart']):
+                self.continue_run()
             raise EspressoNotConverged('Not Converged', os.getcwd())
         if self.calculation_required(force=force):
+            self.set_max_seconds()
             self.write_input()
             self.run()
             self.status = 'running'
@@ -882,6 +897,11 @@ class Espresso(Calculator):
                     return True
             return None
 
+        def read_max_seconds_reached(line):
+            if line.lower().startswith('     maximum cpu time exceeded'):
+                return True
+            return None
+
         def read_calc_finished(line):
             if line.lower().startswith('   job done'):
                 return True
@@ -923,6 +943,43 @@ class Espresso(Calculator):
                 return steps
             return None
 
+        def read_wall_seconds(line):
+            # pw.x prints times as 12.34s, 5m12.34s, 1h 5m or 2d 1h 5m
+            if (line.lower().startswith('     pwscf')
+                and line.rstrip().endswith('WALL')):
+                wall = line.split('CPU')[-1].split('WALL')[0]
+                seconds = 0.
+                for value, unit in re.findall('([0-9.]+)([dhms])', wall):
+                    seconds += float(value) * {'d': 86400, 'h': 3600,
+                                               'm': 60, 's': 1}[unit]
+                return seconds
+            return None
+
+        def read_kpoints(line):
+            if line.lower().startswith('     number of k points='):
+                nkpts = int(line.split('=')[1].split()[0])
+                return nkpts
+            return None
+
+        def read_bands(line):
+            if line.lower().startswith('     number of kohn-sham states='):
+                nbands = int(line.split('=')[-1])
+                return nbands
+            return None
+
+        def read_pools(line):
+            if line.lower().startswith('     k-points division:'):
+                npool = int(line.split()[-1])
+                return npool
+            return None
+
+        def read_ndiag(line):
+            if 'size of sub-group:' in line.lower():
+                group = line.split(':')[-1].replace('*', ' ').split()
+                ndiag = int(group[0]) * int(group[1])
+                return ndiag
+            return None
+
         def read_cputime(i, line):
             if line.lower().startswith('     total cpu'):
                 cputime = float(line.split()[-2])
@@ -960,9 +1017,14 @@ class Espresso(Calculator):
         self.electronic_converged = True
         self.pressure = None
         self.calc_finished = False
+        self.max_seconds_reached = False
         self.all_energies, self.all_forces, self.all_cells, self.all_pos = [], [], [], []
         self.all_tot_magmoms = []
         self.energy_hubbard = 0        
+        self.processors = 1
+        self.npool, self.ndiag = 1, 1
+        self.nkpts, self.nbands = None, None
+        self.wall_seconds = None
         self.all_cells.append(self.atoms.get_cell())
         self.all_pos.append(self.atoms.get_positions())
         self.steps = []
@@ -984,6 +1046,23 @@ class Espresso(Calculator):
             processors = read_processors(line)
             if not processors == None:
                 self.run_params['ppn'] = processors
+                self.processors = processors
+
+            npool = read_pools(line)
+            if not npool == None:
+                self.npool = npool
+
+            ndiag = read_ndiag(line)
+            if not ndiag == None:
+                self.ndiag = ndiag
+
+            nkpts = read_kpoints(line)
+            if not nkpts == None:
+                self.nkpts = nkpts
+
+            nbands = read_bands(line)
+            if not nbands == None:
+                self.nbands = nbands
             
             total_force = read_total_force(line)
             if not total_force == None:
@@ -1006,6 +1085,10 @@ class Espresso(Calculator):
             if not electronic_converged == None:
                 self.electronic_converged = electronic_converged
 
+            max_seconds_reached = read_max_seconds_reached(line)
+            if not max_seconds_reached == None:
+                self.max_seconds_reached = max_seconds_reached
+
             calc_finished = read_calc_finished(line)
             if not calc_finished == None:
                 self.calc_finished = calc_finished
@@ -1029,6 +1112,10 @@ class Espresso(Calculator):
             if not walltime == None:
                 self.walltime = walltime
 
+            wall_seconds = read_wall_seconds(line)
+            if not wall_seconds == None:
+                self.wall_seconds = wall_seconds
+
             cputime = read_cputime(i, line)
             if not cputime == None:
                 self.cputime = cputime
@@ -1162,3 +1249,5 @@ from espresso_lrU import *
 from espresso_run import *
 from espresso_traj import *
 from espresso_dos import *
+from espresso_parallel import *
+from espresso_upf import *
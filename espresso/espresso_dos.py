@@ -2,66 +2,241 @@
 """This module contains functions for analyzing the dos of completed jobs"""
 
 import numpy as np
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from espresso import *
+from espresso_dosgrid import *
+from espresso_upf import *
 from subprocess import call
 
+# These are the projections of each angular momentum in the order
+# projwfc.x writes them
+PDOS_PROJECTIONS = {'s': ['s'],
+                    'p': ['pz', 'px', 'py'],
+                    'd': ['dz2', 'dzx', 'dzy', 'dx2-y2', 'dxy'],
+                    'f': ['fz3', 'fxz2', 'fyz2', 'fz(x2-y2)', 'fxyz',
+                          'fx(x2-3y2)', 'fy(3x2-y2)']}
+
+def read_projwfc_states(fname):
+    '''Reads the atomic states projwfc.x projected on from its output file.
+    Returns a dictionary with a list of (l, j) tuples, one for each
+    wavefunction in the order of their numbers, for every atom index.
+    j is None without spin-orbit coupling.'''
+
+    states = {}
+    f = open(fname, 'r')
+    for line in f:
+        if not line.lstrip().startswith('state #'):
+            continue
+        state = re.search('atom\s+([0-9]+).*wfc\s+([0-9]+)\s+\(l=\s*([0-9]+)'
+                          '(\s+j=\s*([0-9.]+))?', line)
+        atom, wfc, l, j = (int(state.group(1)) - 1, int(state.group(2)),
+                           int(state.group(3)), state.group(5))
+        if j is not None:
+            j = float(j)
+        if not states.has_key(atom):
+            states[atom] = {}
+        states[atom][wfc] = (l, j)
+    f.close()
+
+    for atom in states:
+        states[atom] = [states[atom][wfc] for wfc in sorted(states[atom])]
+
+    return states
+
+def read_pdos_file(fname):
+    '''Reads a file written by projwfc.x. Returns the labels of the columns
+    from the header, starting with 'E', and an array holding the data of
+    each column in a row.'''
+
+    f = open(fname, 'r')
+    header = f.readline()
+    text = f.read()
+    f.close()
+
+    labels = ['E'] + re.findall('([a-zA-Z_]+)\(E\)', header)
+    nlines = text.strip().count('\n') + 1
+    columns = np.fromstring(text, dtype=float, sep=' ')
+    if columns.size != nlines * len(labels):
+        # Fortran drops the E of three digit exponents (1.0-100)
+        text = re.sub('([0-9])([+-][0-9]{3})', '\\1E\\2', text)
+        columns = np.array(text.split(), dtype=float)
+    columns = columns.reshape(nlines, len(labels))
+
+    return labels, np.ascontiguousarray(columns.T)
+
+def read_dos_metadata(fname):
+    '''Reads what EspressoDos needs from a pw.x input file written by
+    Espresso, without initializing a calculator. Returns a dictionary
+    with the keys
+
+    prefix, nspin, pseudo_dir: from the namelists
+    species: the pseudopotential file of each species label, e.g. Ti0
+    labels: the species label of each atom
+    symbols: the chemical symbol of each atom
+    scaled_positions, cell: the initial structure'''
+
+    metadata = {'prefix': None, 'nspin': 1, 'pseudo_dir': None, 'species': {}}
+    lines = open(fname, 'r').readlines()
+    for i, line in enumerate(lines):
+        data = line.replace('=', ' = ').split()
+        if len(data) == 0:
+            continue
+        key = data[0].lower()
+        if key in ('prefix', 'pseudo_dir'):
+            metadata[key] = data[2].strip("'")
+        elif key == 'nspin':
+            metadata[key] = int(data[2])
+        elif key == 'atomic_species':
+            j = 1
+            while i + j < len(lines) and lines[i + j][0] == ' ':
+                metadata['species'][lines[i + j].split()[0]] = lines[i + j].split()[2]
+                j += 1
+        elif key == 'atomic_positions':
+            j = 1
+            labels, positions = [], []
+            while i + j < len(lines) and lines[i + j][0] == ' ':
+                labels.append(lines[i + j].split()[0])
+                positions.append([float(x) for x in lines[i + j].split()[1:4]])
+                j += 1
+            metadata['labels'] = labels
+            metadata['symbols'] = [label.translate(None, digits) for label in labels]
+            metadata['scaled_positions'] = np.array(positions)
+        elif key == 'cell_parameters':
+            metadata['cell'] = np.array([[float(x) for x in lines[i + k].split()[:3]]
+                                         for k in (1, 2, 3)])
+
+    return metadata
+
+def read_fermi_level(fname):
+    '''Returns the last Fermi energy in eV printed in a pw.x output file'''
+
+    efermi = None
+    for line in open(fname, 'r'):
+        if 'the Fermi energy is' in line:
+            efermi = float(line.split()[-2])
+    if efermi is None:
+        raise EspressoNotFinished('No Fermi level in {0}'.format(fname))
+
+    return efermi
+
 class EspressoDos(object):
     """Class for representing density-of-states produced via quantum-espresso
     """
 
-    def __init__(self, efermi=0.0):
+    def __init__(self, efermi=0.0, cache=False, dtype=np.float64, projwfc='serial',
+                 path=None):
         """Initialize the class. The key variable for storing data is
         the self.dos_dict. This initialize function and creates empty
         dictionaries for when we actually want to read the data.
 
         This also creates a corresponding self.anal_dict dictionary
-        for storing properties of the d-band."""
-
-        self.efermi = efermi
-        self.calc = Espresso()
-        PPs = self.calc.PPs
+        for storing properties of the d-band.
+
+        With cache=True all of the DOS files are stored in binary form in
+        the [prefix].dos.cache directory the first time, and read from
+        there afterwards as long as the DOS files have not changed. The
+        cache is memory-mapped, so large calculations can be analyzed
+        without reading all of the projections into memory.
+
+        dtype sets the precision the densities are stored in. np.float32
+        halves the memory and cache size.
+
+        projwfc sets how projwfc.x is run when the DOS files are missing.
+        'serial' runs it here and waits for it. 'queue' submits it to the
+        queue with the processors and pools of the calculation and raises
+        EspressoSubmitted, 'local' starts it in the background and raises
+        EspressoRunning. Initializing the class again after the run has
+        finished reads the results. While it is running EspressoRunning
+        is raised.
+
+        With path set the calculation in that directory is read without
+        changing into it. Instead of initializing an Espresso calculator,
+        which reads the output and asks the queue about the job, only the
+        atoms, prefix, spin and pseudopotentials are read from the input
+        file. This is safe to do for many directories at once in threads
+        or processes. self.calc is None then. Only running projwfc.x needs
+        the calculator, and the directory is changed into while it starts.
+
+        With efermi=None the Fermi level is read from the output file."""
+
+        self.dtype = np.dtype(dtype)
+        self.cached_files = None
+        self.zeros = None
+
+        if path == None:
+            self.path = os.getcwd()
+            self.calc = Espresso()
+            filename = self.calc.filename
+            nspin = self.calc.int_params['nspin']
+            prefix = self.calc.string_params['prefix']
+            self.chemical_syms = self.calc.atoms.get_chemical_symbols()
+            self.special_syms = self.calc.new_symbols
+            self.scaled_positions = self.calc.atoms.get_scaled_positions()
+            self.cell = self.calc.atoms.get_cell()
+            pseudo_dir = self.calc.string_params['pseudo_dir']
+            pseudo_files = dict([(sym, self.calc.PPs[sym][0]) for sym in self.chemical_syms])
+        else:
+            self.path = os.path.abspath(os.path.expanduser(path))
+            self.calc = None
+            filename = 'pwscf'
+            metadata = read_dos_metadata(os.path.join(self.path, filename + '.in'))
+            nspin = metadata['nspin']
+            prefix = metadata['prefix']
+            self.chemical_syms = metadata['symbols']
+            self.special_syms = metadata['labels']
+            self.scaled_positions = metadata['scaled_positions']
+            self.cell = metadata['cell']
+            pseudo_dir = metadata['pseudo_dir']
+            pseudo_files = dict([(sym, metadata['species'][label]) for sym, label
+                                 in zip(self.chemical_syms, self.special_syms)])
 
         # Check to see if the calculation is magnetic
-        if self.calc.int_params['nspin'] == 2:
+        if nspin == 2:
             self.mag = True
         else:
             self.mag = False
 
-        if self.calc.string_params['prefix'] == None:
+        if prefix == None:
             self.prefix = 'pwscf'
         else:
-            self.prefix = self.calc.string_params['prefix']
+            self.prefix = prefix
 
-        natoms = self.calc.atoms.get_number_of_atoms()
+        if efermi == None:
+            efermi = read_fermi_level(os.path.join(self.path, filename + '.out'))
+        self.efermi = efermi
 
         # First generate the DOS files if they are not there yet
-        if not os.path.exists(self.prefix + '.dos.out'):
-            self.write_dos_input()
-            dos_input = open(self.prefix + '.dos.in', 'r')
-            dos_output = open(self.prefix + '.dos.out', 'w')
-            call(['projwfc.x'], stdin=dos_input, stdout=dos_output)
+        if (not os.path.exists(self.get_file(self.prefix + '.dos.out'))
+            or os.path.exists(self.get_file('jobid-dos'))
+            or os.path.exists(self.get_file('pid-dos'))):
+            if self.calc is None:
+                with Espresso(self.path) as calc:
+                    self.write_dos_files(calc, projwfc)
+            else:
+                self.write_dos_files(self.calc, projwfc)
 
         # Because the output depends on the pseudopotential,
         # we first need to store which projections we need.
-        syms = set(self.calc.atoms.get_chemical_symbols())
+        syms = set(self.chemical_syms)
         self.proj_dict = {}
         for sym in syms:
-            PP_file = open(self.calc.string_params['pseudo_dir'] 
-                           + '/{0}'.format(PPs[sym][0]), 'r')
-            lines = PP_file.readlines()
-            self.proj_dict[sym] = []
-            i = 0
-            for line in lines:
-                if line.lower().startswith(' wavefunctions'):
-                    while not lines[i+1].startswith('</PP_HEADER>'):
-                        self.proj_dict[sym].append(lines[i+1].split()[0].lower())
-                        i += 1
-                    break
-                i += 1
+            info = get_upf_info(os.path.join(pseudo_dir, pseudo_files[sym]))
+            self.proj_dict[sym] = list(info['wavefunctions'])
+
+        # With spin-orbit coupling every wavefunction is split by j. These
+        # get their own orbital names, such as 4f_j2.5 and 4f_j3.5
+        self.states = read_projwfc_states(self.get_file(self.prefix + '.dos.out'))
+        for sym in syms:
+            atom = self.chemical_syms.index(sym)
+            if not self.states.has_key(atom):
+                continue
+            for i, (l, j) in enumerate(self.states[atom][:len(self.proj_dict[sym])]):
+                if j is not None:
+                    self.proj_dict[sym][i] += '_j{0:.1f}'.format(j)
 
         # Make an empty dictionary file for storing the raw densities
         self.dos_dict = {}
-        self.chemical_syms = self.calc.atoms.get_chemical_symbols()
         
         for i, sym in enumerate(self.chemical_syms):
             self.dos_dict[i] = {}
@@ -70,35 +245,130 @@ class EspressoDos(object):
 
         # Make an empty dictionary file for storing properties of the densities
         self.anal_dict = {}
-        
-        for i, sym in enumerate(self.chemical_syms):
-            self.dos_dict[i] = {}
-            for orbital in self.proj_dict[sym]:
-                self.dos_dict[i][orbital] = None
+
+        if cache == True:
+            self.read_cache()
 
         # Finally, read the total density of states file. This will also get the energies
-        self.energies, self.total_dos_up, self.total_dos_down = [], [], []
-        self.total_dos = []
         tot_dos_name = '{0}.pdos_tot'.format(self.prefix)
-        f = open(tot_dos_name, 'r')
-        f.readline()
-        for line in f:
-            line = line.split()
-            self.energies.append(float(line[0]) - self.efermi)
-            if self.mag == True:
-                self.total_dos_up.append(float(line[3]))
-                self.total_dos_down.append(float(line[4]))
-                self.total_dos.append(float(line[3]) + float(line[4]))
-            else:
-                self.total_dos.append(float(line[2]))
-        f.close()        
+        labels, columns = self.read_columns(tot_dos_name)
+        self.energies = columns[0] - self.efermi
+        if 'pdosup' in labels:
+            self.total_dos_up = columns[labels.index('pdosup')]
+            self.total_dos_down = columns[labels.index('pdosdw')]
+            self.total_dos = self.total_dos_up + self.total_dos_down
+        else:
+            self.total_dos_up, self.total_dos_down = np.array([]), np.array([])
+            self.total_dos = columns[labels.index('pdos')]
         
         return
 
+    def read_cache(self):
+        """Reads all of the DOS files from the binary cache. The cache is
+        (re)written from the text files if it does not exist, if it was
+        written with a different dtype, or if the files or their
+        modification times differ from when it was written.
+
+        The cache is a directory holding meta.npz, with the names, times,
+        labels and first row of each file, and columns.npy, with the
+        columns of all of the files stacked in one array. columns.npy is
+        memory-mapped, so only the columns that are used are read."""
+
+        cache_dir = self.get_file(self.prefix + '.dos.cache')
+        fnames = ([self.prefix + '.pdos_tot']
+                  + sorted([os.path.basename(fname) for fname in
+                            glob.glob(self.get_file(self.prefix + '.pdos_atm#*'))]))
+        mtimes = np.array([os.path.getmtime(self.get_file(fname)) for fname in fnames])
+
+        meta_name = os.path.join(cache_dir, 'meta.npz')
+        columns_name = os.path.join(cache_dir, 'columns.npy')
+        valid = False
+        if os.path.exists(meta_name) and os.path.exists(columns_name):
+            meta = np.load(meta_name)
+            valid = (list(meta['files']) == fnames
+                     and np.array_equal(meta['mtimes'], mtimes)
+                     and 'dtype' in meta.files
+                     and str(meta['dtype']) == self.dtype.str)
+
+        # Read the text files and write the cache if needed
+        if valid == False:
+            all_labels, all_columns, starts = [], [], []
+            start = 0
+            for fname in fnames:
+                labels, columns = read_pdos_file(self.get_file(fname))
+                all_labels.append(' '.join(labels))
+                all_columns.append(columns.astype(self.dtype))
+                starts.append(start)
+                start += len(labels)
+
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+
+            # Write to temporary files first, because other calculators or
+            # processes may still have the old columns memory-mapped
+            tmp_name = '{0}.{1:d}'.format(columns_name, os.getpid())
+            f = open(tmp_name, 'wb')
+            np.save(f, np.vstack(all_columns))
+            f.close()
+            os.rename(tmp_name, columns_name)
+            tmp_name = '{0}.{1:d}'.format(meta_name, os.getpid())
+            f = open(tmp_name, 'wb')
+            np.savez(f, files=np.array(fnames), mtimes=mtimes,
+                     labels=np.array(all_labels), starts=np.array(starts),
+                     dtype=np.array(self.dtype.str))
+            f.close()
+            os.rename(tmp_name, meta_name)
+            del all_columns
+            meta = np.load(meta_name)
+
+        columns = np.load(columns_name, mmap_mode='r')
+        self.cached_files = {}
+        for fname, labels, start in zip(meta['files'], meta['labels'], meta['starts']):
+            labels = str(labels).split()
+            self.cached_files[str(fname)] = (labels, columns[start:start + len(labels)])
+
+        return
+
+    def read_columns(self, fname):
+        """Returns the labels and columns of a DOS file, from the cache
+        if it has been read"""
+
+        if self.cached_files is not None and self.cached_files.has_key(fname):
+            return self.cached_files[fname]
+        labels, columns = read_pdos_file(self.get_file(fname))
+        return labels, columns.astype(self.dtype, copy=False)
+
+    def get_file(self, fname):
+        """Returns the path of a file in the directory of the calculation"""
+
+        return os.path.join(self.path, fname)
+
+    def write_dos_files(self, calc, projwfc='serial'):
+        """Runs projwfc.x in the directory of the calculation, which has to
+        be the working directory. See __init__ for the values of projwfc."""
+
+        if calc.projwfc_running():
+            raise EspressoRunning('Running', os.getcwd())
+        if os.path.exists(self.prefix + '.dos.out'):
+            return
+
+        self.write_dos_input()
+        if projwfc == 'queue':
+            calc.run_projwfc(self.prefix + '.dos.in', self.prefix + '.dos.out')
+            raise EspressoSubmitted(open('jobid-dos').read())
+        elif projwfc == 'local':
+            calc.run_projwfc(self.prefix + '.dos.in', self.prefix + '.dos.out', local=True)
+            raise EspressoRunning('Running', os.getcwd())
+        dos_input = open(self.prefix + '.dos.in', 'r')
+        dos_output = open(self.prefix + '.dos.out', 'w')
+        call([ESPRESSORC.get('projwfc', 'projwfc.x')], stdin=dos_input, stdout=dos_output)
+
+        return
+
     def write_dos_input(self):
         """Writes the input file for the dos calculation."""
 
-        in_file = open(self.prefix + '.dos.in', 'w')
+        in_file = open(self.get_file(self.prefix + '.dos.in'), 'w')
         
         in_file.write('&PROJWFC\n')
         in_file.write('/\n')
@@ -112,103 +382,71 @@ class EspressoDos(object):
         if self.dos_dict[atom][orbital] is not None:
             return
         dos_name = '{0}.pdos_atm#{1}({2})_wfc#{3}({4})'
-        self.special_syms = self.calc.new_symbols
-        fname = dos_name.format(self.prefix, atom + 1, self.special_syms[atom],
-                                self.proj_dict[self.chemical_syms[atom]].index(orbital) + 1,
-                                orbital[-1])
+        wfc = self.proj_dict[self.chemical_syms[atom]].index(orbital) + 1
+
+        # The angular momentum is taken from the projwfc.x output if
+        # it is there, and from the name of the orbital otherwise
+        j = None
+        if self.states.has_key(atom):
+            l, j = self.states[atom][wfc - 1]
+            l = 'spdf'[l]
+        else:
+            l = orbital.split('_')[0][-1]
+        if j is None:
+            label = l
+        else:
+            label = '{0}_j{1:.1f}'.format(l, j)
 
-        dos  = self.read_dosfile(fname, orbital[-1])
+        fname = dos_name.format(self.prefix, atom + 1, self.special_syms[atom], wfc, label)
+        dos  = self.read_dosfile(fname, l, j)
         self.dos_dict[atom][orbital] = dos
         
         return        
 
-    def read_dosfile(self, fname, orbital):
+    def read_dosfile(self, fname, orbital, j=None):
         '''This read a single file and returns a dictionary file that contains
-        a specific atom's specific orbital's projected density of states'''
-        
-        if orbital == 's':
-            data = {'tot+':[], 'tot-':[], 's+':[], 's-':[]}
-            f = open(fname, 'r')
-            f.readline()
-            for line in f:
-                line = line.split()
-                if self.mag == True:
-                    data['tot+'].append(float(line[1]))
-                    data['tot-'].append(float(line[2]))
-                    data['s+'].append(float(line[3]))
-                    data['s-'].append(float(line[4]))
-                else:
-                    data['tot+'].append(float(line[1]))
-                    data['tot-'].append(0)
-                    data['s+'].append(float(line[2]))
-                    data['s-'].append(float(0))
-            f.close()
-            return data
-        
-        if orbital == 'p':
-            data = {'tot+':[], 'tot-':[], 'pz+':[], 'pz-':[],
-                    'px+':[], 'px-':[], 'py+':[], 'py-':[]}
-            f = open(fname, 'r')
-            f.readline()
-            for line in f:
-                line = line.split()
-                if self.mag == True:
-                    data['tot+'].append(float(line[1]))
-                    data['tot-'].append(float(line[2]))
-                    data['pz+'].append(float(line[3]))
-                    data['pz-'].append(float(line[4]))
-                    data['px+'].append(float(line[5]))
-                    data['px-'].append(float(line[6]))
-                    data['py+'].append(float(line[7]))
-                    data['py-'].append(float(line[8]))
-                else:
-                    data['tot+'].append(float(line[1]))
-                    data['tot-'].append(0)
-                    data['pz+'].append(float(line[2]))
-                    data['pz-'].append(0)
-                    data['px+'].append(float(line[3]))
-                    data['px-'].append(0)
-                    data['py+'].append(float(line[4]))
-                    data['py-'].append(0)
-            f.close()
-            return data
-
-        if orbital == 'd':
-            data = {'tot+':[], 'tot-':[], 'dz2+':[], 'dz2-':[],
-                    'dzx+':[], 'dzx-':[], 'dzy+':[], 'dzy-':[],
-                    'dx2-y2+':[], 'dx2-y2-':[], 'dxy+':[], 'dxy-':[]}
-            f = open(fname, 'r')
-            f.readline()
-            for line in f:
-                line = line.split()
-                if self.mag == True:
-                    data['tot+'].append(float(line[1]))
-                    data['tot-'].append(float(line[2]))
-                    data['dz2+'].append(float(line[3]))
-                    data['dz2-'].append(float(line[4]))
-                    data['dzx+'].append(float(line[5]))
-                    data['dzx-'].append(float(line[6]))
-                    data['dzy+'].append(float(line[7]))
-                    data['dzy-'].append(float(line[8]))
-                    data['dx2-y2+'].append(float(line[9]))
-                    data['dx2-y2-'].append(float(line[10]))
-                    data['dxy+'].append(float(line[11]))
-                    data['dxy-'].append(float(line[12]))
-                else:
-                    data['tot+'].append(float(line[1]))
-                    data['tot-'].append(0)
-                    data['dz2+'].append(float(line[2]))
-                    data['dz2-'].append(0)
-                    data['dzx+'].append(float(line[3]))
-                    data['dzx-'].append(0)
-                    data['dzy+'].append(float(line[4]))
-                    data['dzy-'].append(0)
-                    data['dx2-y2+'].append(float(line[5]))
-                    data['dx2-y2-'].append(0)
-                    data['dxy+'].append(float(line[6]))
-                    data['dxy-'].append(0)                    
-            f.close()
-            return data
+        a specific atom's specific orbital's projected density of states.
+        The columns are named from the header of the file. Each entry of the
+        dictionary is a row of a single array holding the whole file.
+
+        orbital is the letter of the angular momentum. With spin-orbit
+        coupling j is the total angular momentum, and the projections are
+        named by m_j, e.g. mj-0.5 and mj0.5 for j = 0.5. Spin-orbit and
+        non-magnetic files only have + columns.'''
+
+        labels, columns = self.read_columns(fname)
+
+        if j is None:
+            projections = PDOS_PROJECTIONS.get(orbital, [])
+        else:
+            projections = ['mj{0:g}'.format(mj) for mj in np.arange(-j, j + 1)]
+        pdos_labels = [label for label in labels if label.startswith('pdos')]
+        spin = [label.endswith('up') for label in labels].count(True) > 0
+        if spin == True:
+            nproj = len(pdos_labels) / 2
+        else:
+            nproj = len(pdos_labels)
+        if len(projections) != nproj:
+            projections = ['m{0:d}'.format(m + 1) for m in range(nproj)]
+
+        names = ['tot']
+        for proj in projections:
+            names.append(proj)
+
+        # Non-magnetic calculations have no spin down columns. These
+        # all point to the same array of zeros.
+        if self.zeros is None:
+            self.zeros = np.zeros(columns.shape[1], dtype=self.dtype)
+        zeros = self.zeros
+        data = {}
+        for i, name in enumerate(names):
+            if spin == True:
+                data[name + '+'] = columns[2 * i + 1]
+                data[name + '-'] = columns[2 * i + 2]
+            else:
+                data[name + '+'] = columns[i + 1]
+                data[name + '-'] = zeros
+        return data
 
     def get_energies(self):
         return np.array(self.energies)
@@ -240,7 +478,14 @@ class EspressoDos(object):
                        s orbital: s (same as total)
                        p orbital: px, py, pz
                        d orbital: dz2, dzx, dzy, dx2-y2, dxy
+                       f orbital: fz3, fxz2, fyz2, fz(x2-y2), fxyz,
+                                  fx(x2-3y2), fy(3x2-y2)
+                       spin-orbit: mj-j, ..., mjj, e.g. mj-0.5, mj0.5
+                                   for the orbital 6s_j0.5
         spin can be either +, -, or None
+
+        With a single spin the stored array is returned without copying.
+        When it comes from the cache it is read-only.
         '''
 
         self.update(atom, orbital)
@@ -253,95 +498,348 @@ class EspressoDos(object):
                 spin_up = self.dos_dict[atom][orbital][proj + '+']
                 spin_down = self.dos_dict[atom][orbital][proj + '-']
 
-            return np.array(spin_up) + np.array(spin_down)
+            if spin_down is self.zeros:
+                return np.array(spin_up)
+            return spin_up + spin_down
 
         else:
             if proj == None:
-                return np.array(self.dos_dict[atom][orbital]['tot' + spin])
+                return np.asarray(self.dos_dict[atom][orbital]['tot' + spin])
             else:
-                return np.array(self.dos_dict[atom][orbital][proj + spin])
+                return np.asarray(self.dos_dict[atom][orbital][proj + spin])
 
         
+    def get_dos_array(self, projections, grid=None, width=None, kind='gaussian', spin=None):
+        '''Return the densities of many projections stacked into one array,
+        with a row for each projection. projections is a list of (atom, orbital)
+        or (atom, orbital, proj) tuples as in get_band_descriptors(), and 'total'
+        can be used for the total density of states.
+
+        grid (array): Energies relative to the Fermi level to interpolate onto,
+                      for example from get_energy_grid(). By default the
+                      energies of the calculation are kept.
+
+        width, kind: The broadening applied to all of the rows together,
+                     see broaden_dos(). Broadening needs an evenly spaced
+                     grid, which the energies of projwfc.x are.'''
+
+        energies = self.get_energies()
+        dos = np.empty((len(projections), len(energies)), dtype=self.dtype)
+        for i, projection in enumerate(projections):
+            if projection == 'total':
+                dos[i] = self.get_total_dos(spin)
+                continue
+            atom, orbital = projection[:2]
+            if len(projection) > 2:
+                proj = projection[2]
+            else:
+                proj = None
+            dos[i] = self.get_site_dos(atom, orbital, proj, spin)
+
+        if grid is not None:
+            dos = resample_dos(energies, dos, grid)
+            energies = grid
+        if width is not None:
+            dos = broaden_dos(energies, dos, width, kind)
+
+        return dos
+
+    def get_orbitals(self, atoms, orbital):
+        '''Return the (atom, orbital) pairs of a group of atoms.
+
+        atoms: A chemical symbol, which selects all atoms of that element,
+               or a list of atom indices
+
+        orbital (string): The name of an orbital such as 3d, or just the
+                          angular momentum, such as d, to take every
+                          wavefunction of that angular momentum. With
+                          spin-orbit coupling 3d selects both 3d_j1.5 and
+                          3d_j2.5.'''
+
+        if isinstance(atoms, str):
+            atoms = [i for i, sym in enumerate(self.chemical_syms) if sym == atoms]
+
+        pairs = []
+        for atom in atoms:
+            for name in self.proj_dict[self.chemical_syms[atom]]:
+                wavefunction = name.split('_')[0]
+                if orbital in (name, wavefunction, wavefunction[-1]):
+                    pairs.append((atom, name))
+        return pairs
+
+    def read_orbitals(self, pairs, threads=4):
+        '''Read the files of many (atom, orbital) pairs at once in a pool of
+        threads. Files that have already been read are skipped.'''
+
+        pairs = [(atom, orbital) for atom, orbital in set(pairs)
+                 if self.dos_dict[atom][orbital] is None]
+        if len(pairs) == 0:
+            return
+        # The array of zeros is shared by all files, so make it only once
+        if self.zeros is None:
+            self.zeros = np.zeros(len(self.energies), dtype=self.dtype)
+        if threads <= 1 or len(pairs) == 1:
+            for atom, orbital in pairs:
+                self.update(atom, orbital)
+            return
+
+        pool = ThreadPool(min(threads, len(pairs)))
+        try:
+            pool.map(lambda pair: self.update(*pair), pairs)
+        finally:
+            pool.close()
+            pool.join()
+
+        return
+
+    def get_atoms_dos(self, atoms, orbital, proj=None, spin=None, threads=4):
+        '''Return the sum of the site projected density of states of a group
+        of atoms, for example all of the Ti d states with atoms='Ti' and
+        orbital='d'. atoms and orbital are as in get_orbitals() and proj and
+        spin are as in get_site_dos(). The files are read with read_orbitals().'''
+
+        pairs = self.get_orbitals(atoms, orbital)
+        if len(pairs) == 0:
+            raise ValueError('no {0} orbitals on the atoms {1}'.format(orbital, atoms))
+        self.read_orbitals(pairs, threads)
+
+        dos = np.empty((len(pairs), len(self.energies)), dtype=self.dtype)
+        for i, (atom, name) in enumerate(pairs):
+            dos[i] = self.get_site_dos(atom, name, proj, spin)
+
+        return dos.sum(axis=0)
+
+    def get_shell_atoms(self, center, shell=1, symbol=None, tol=0.1):
+        '''Return the indices of the atoms in a coordination shell around
+        the atom center, taking periodic images into account. Atoms are in
+        the same shell when their distance is within a fraction tol of the
+        closest atom of the shell. Only atoms of the element symbol are
+        counted if it is given.'''
+
+        positions = self.scaled_positions
+        if symbol is None:
+            indices = np.arange(len(positions))
+        else:
+            indices = np.array([i for i, sym in enumerate(self.chemical_syms) if sym == symbol])
+        indices = indices[indices != center]
+        if len(indices) == 0:
+            return []
+
+        # The shortest distance to each atom is found by checking the
+        # neighboring cells, after wrapping into the closest one
+        vectors = positions[indices] - positions[center]
+        vectors -= np.round(vectors)
+        images = np.array([(i, j, k) for i in (-1, 0, 1)
+                           for j in (-1, 0, 1) for k in (-1, 0, 1)])
+        vectors = vectors[:, np.newaxis, :] + images[np.newaxis, :, :]
+        distances = np.sqrt((np.dot(vectors, self.cell) ** 2).sum(axis=2)).min(axis=1)
+
+        order = np.argsort(distances)
+        start = distances[order[0]]
+        n = 1
+        members = []
+        for i in order:
+            if distances[i] > start * (1 + tol):
+                if n == shell:
+                    break
+                n += 1
+                start = distances[i]
+            if n == shell:
+                members.append(indices[i])
+
+        return sorted(members)
+
+    def get_shell_dos(self, center, orbital, shell=1, symbol=None, proj=None,
+                      spin=None, tol=0.1, threads=4):
+        '''Return the summed density of states of an orbital over a
+        coordination shell around the atom center, for example the O p
+        states of the first shell with orbital='p' and symbol='O'. The shell
+        is found with get_shell_atoms() and the sum with get_atoms_dos().'''
+
+        atoms = self.get_shell_atoms(center, shell, symbol, tol)
+        return self.get_atoms_dos(atoms, orbital, proj, spin, threads)
+
     def get_number_of_states(self, atom, orbital, proj=None, spin=False, limits=None):
         '''Return the number of states in a band. The inputs are the
         same as get_site_dos() funciton. The limits defines the limits on the calculation
-        of the number of states'''
+        of the number of states. With spin=True the spin up and down numbers are returned'''
         
-        energies = self.get_energies()
-        if limits == None:
-            ind = (energies <= energies.max()) & (energies >= energies.min())
-        else:
-            ind = (energies <= limits[1]) & (energies >= limits[0])
-        energies = energies[ind]
-
-        if spin == False:
-            states = self.get_site_dos(atom, orbital, proj, spin)[ind]
-            return np.trapz(states, energies)
-        else:
-            up_states, down_states = self.get_site_dos(atom, orbital, proj, spin)
-            up_states = up_states[ind]
-            down_states = down_states[ind]
-            return np.trapz(up_states, energies), np.trapz(down_states, energies)
+        return self.get_band_property('filling', atom, orbital, proj, spin, limits)
 
     def get_band_center(self, atom, orbital, proj=None, spin=False, limits=None):
         '''Return the band center of a specific atomic orbital. The inputs are the
         same as get_site_dos() funciton. The limits defines the limits on the calculation
         of the band center'''
         
-        energies = self.get_energies()
-        if limits == None:
-            ind = (energies <= energies.max()) & (energies >= energies.min())
-        else:
-            ind = (energies <= limits[1]) & (energies >= limits[0])
-        energies = energies[ind]
-
-        if spin == False:
-            states = self.get_site_dos(atom, orbital, proj, spin)[ind]
-            n_states = np.trapz(states, energies)
-            return np.trapz(energies * states, energies) / n_states
-        else:
-            up_states, down_states = self.get_site_dos(atom, orbital, proj, spin)
-            up_states = up_states[ind]
-            down_states = down_states[ind]
-            nup_states = np.trapz(up_states, energies)
-            ndown_states = np.trapz(down_states, energies)
-            nup_center = np.trapz(energies * up_states, energies) / nup_states
-            ndown_center = np.trapz(energies * down_states, energies) / ndown_states
-            return nup_center, ndown_center
+        return self.get_band_property('center', atom, orbital, proj, spin, limits)
 
     def get_band_width(self, atom, orbital, proj=None, spin=False, limits=None):
         '''Return the band width of a specific atomic orbital. The inputs are the
         same as get_site_dos() funciton. The limits defines the limits on the calculation
         of the band width'''
         
-        energies = self.get_energies()
-        if limits == None:
-            ind = (energies <= energies.max()) & (energies >= energies.min())
-        else:
-            ind = (energies <= limits[1]) & (energies >= limits[0])
-        energies = energies[ind]
+        return self.get_band_property('width', atom, orbital, proj, spin, limits)
 
-        if spin == False:
-            states = self.get_site_dos(atom, orbital, proj, spin)[ind]
-            n_states = np.trapz(states, energies)
-            center = np.trapz(energies * states, energies) / n_states
-            centers = center * np.ones(len(energies))
-            return np.sqrt(np.trapz((energies - centers) ** 2 * states, energies) / n_states)
-                                      
-        else:
-            up_states, down_states = self.get_site_dos(atom, orbital, proj, spin)
-            up_states = up_states[ind]
-            down_states = down_states[ind]
-            nup_states = np.trapz(up_states, energies)
-            ndown_states = np.trapz(down_states, energies)
-            nup_center = np.trapz(energies * up_states, energies) / nup_states
-            ndown_center = np.trapz(energies * down_states, energies) / ndown_states
-            nup_centers = nup_center * np.ones(len(energies))
-            ndown_centers = ndown_center * np.ones(len(energies))
-            nup_width = np.sqrt(np.trapz((energies - nup_centers) ** 2 
-                                         * up_states, energies) / nup_states)
-            ndown_width = np.sqrt(np.trapz((energies - ndown_centers) ** 2 
-                                           * down_states, energies) / ndown_states)
-            return nup_width, ndown_width
-            
+    def get_band_property(self, key, atom, orbital, proj=None, spin=False, limits=None):
+        '''Return one of the properties computed by get_band_descriptors() for
+        a single orbital. spin can be +, -, False or None for both spins
+        together, or True for a (spin up, spin down) tuple.'''
 
+        if spin == True:
+            return tuple([self.get_band_descriptors([(atom, orbital, proj)], s, limits)[key][0]
+                          for s in ('+', '-')])
+        if spin == False:
+            spin = None
+        return self.get_band_descriptors([(atom, orbital, proj)], spin, limits)[key][0]
+
+    def get_cumulative_moments(self, projections, spin=None):
+        '''Return the cumulative integrals of the density of states times
+        E**n, n = 0 to 4, of many projections as an array of shape
+        (projections, 5, energies). The integrals of a projection are
+        computed once and kept in self.anal_dict, so the integral over any
+        window is the difference of two interpolated values.'''
+
+        energies = self.get_energies().astype(float)
+        keys = []
+        for projection in projections:
+            atom, orbital = projection[:2]
+            if len(projection) > 2:
+                proj = projection[2]
+            else:
+                proj = None
+            keys.append((atom, orbital, proj, spin))
+
+        missing = [key for key in set(keys) if not self.anal_dict.has_key(key)]
+        if len(missing) > 0:
+            self.read_orbitals([key[:2] for key in missing])
+            dos = np.empty((len(missing), 1, len(energies)))
+            for i, key in enumerate(missing):
+                dos[i, 0] = self.get_site_dos(*key)
+            integrand = dos * energies ** np.arange(5)[:, np.newaxis]
+            cumulative = np.zeros(integrand.shape)
+            cumulative[:, :, 1:] = np.cumsum((integrand[:, :, 1:] + integrand[:, :, :-1])
+                                             * (np.diff(energies) / 2), axis=2)
+            for i, key in enumerate(missing):
+                self.anal_dict[key] = cumulative[i]
+
+        return np.array([self.anal_dict[key] for key in keys])
+
+    def get_band_descriptors(self, projections, spin=None, limits=None):
+        '''Return the filling, center, width, skewness and kurtosis of many
+        projected densities of states at once. projections is a list of
+        (atom, orbital) or (atom, orbital, proj) tuples with the same
+        meaning as in get_site_dos(), and spin can be either +, -, or None.
+
+        The limits define the energy window used for all of them. They can
+        also be an array of many (lower, upper) windows, which are all
+        answered at once. The integrals come from get_cumulative_moments(),
+        so each window only costs a search of the energies. The moments
+        about the center are found from the moments about zero energy, which
+        is accurate when efermi is set so the bands are near zero.
+
+        Returns a dictionary of arrays under the keys 'filling', 'center',
+        'width', 'skewness' and 'kurtosis', with one element per projection,
+        or shape (projections, windows) for many windows. The kurtosis is
+        not reduced by 3.'''
+
+        energies = self.get_energies().astype(float)
+        if limits is None:
+            limits = (energies[0], energies[-1])
+        limits = np.clip(np.asarray(limits, dtype=float), energies[0], energies[-1])
+        windows = limits.reshape(-1, 2)
+
+        cumulative = self.get_cumulative_moments(projections, spin)
+        bounds = resample_dos(energies, cumulative, windows.ravel())
+        bounds = bounds.reshape(bounds.shape[:2] + windows.shape)
+        raw = bounds[..., 1] - bounds[..., 0]
+
+        filling = raw[:, 0]
+        center = raw[:, 1] / filling
+        m2, m3, m4 = raw[:, 2] / filling, raw[:, 3] / filling, raw[:, 4] / filling
+        variance = m2 - center ** 2
+        third = m3 - 3 * center * m2 + 2 * center ** 3
+        fourth = m4 - 4 * center * m3 + 6 * center ** 2 * m2 - 3 * center ** 4
+        width = np.sqrt(variance)
+
+        descriptors = {'filling': filling,
+                       'center': center,
+                       'width': width,
+                       'skewness': third / width ** 3,
+                       'kurtosis': fourth / width ** 4}
+        if limits.ndim == 1:
+            for key in descriptors:
+                descriptors[key] = descriptors[key][:, 0]
+
+        return descriptors
+
+def read_stacked_dos(args):
+    '''Reads the densities of one calculation for stack_dos() in a worker
+    process. Returns the array of densities and a dictionary of metadata.'''
+
+    espressodir, projections, grid, width, kind, spin, cache = args
+    meta = {'dir': espressodir, 'efermi': None, 'projections': [], 'error': None}
+
+    try:
+        dos = EspressoDos(efermi=None, cache=cache, path=espressodir)
+        if callable(projections):
+            projections = projections(dos)
+        meta['efermi'] = dos.efermi
+        meta['projections'] = list(projections)
+        data = dos.get_dos_array(projections, grid, width, kind, spin)
+    except (IOError, OSError, ValueError, IndexError, EspressoNotFinished) as e:
+        # Missing or unfinished files are recorded, everything else stops
+        # stack_dos. Exceptions do not always survive being sent back from
+        # the worker, so only the message is kept.
+        meta['error'] = '{0}: {1}'.format(e.__class__.__name__, e)
+        data = None
+
+    return data, meta
+
+def stack_dos(espressodirs, projections, grid=None, width=None, kind='gaussian',
+              spin=None, processes=None, cache=False, dtype=np.float64):
+    '''Reads the densities of states of many calculations in parallel and
+    stacks them on a common energy grid relative to each Fermi level.
+
+    espressodirs (list): The directories of the finished calculations
+
+    projections: A list of projections as in EspressoDos.get_dos_array(),
+                 used for every calculation, or a function that takes the
+                 EspressoDos of a calculation and returns its list. The
+                 function is sent to the worker processes, so it has to be
+                 defined at the top level of a module.
+
+    grid (array): Energies relative to the Fermi level. By default -10 to
+                  10 eV in steps of 0.01 eV.
+
+    width, kind, spin: The broadening and spin, see get_dos_array()
+
+    processes (int): The number of worker processes, by default the number
+                     of cores
+
+    Returns the grid, an array of shape (calculations, projections, energies)
+    and a list with a dictionary of metadata for every calculation, holding
+    its 'dir', 'efermi', 'projections' and an 'error' message if it could not
+    be read. Rows of calculations with fewer projections than the others,
+    or that could not be read, are filled with NaN.'''
+
+    if grid is None:
+        grid = get_energy_grid(-10., 10., 0.01)
+    grid = np.asarray(grid, dtype=float)
+    espressodirs = [os.path.abspath(os.path.expanduser(d)) for d in espressodirs]
+    args = [(d, projections, grid, width, kind, spin, cache) for d in espressodirs]
+
+    pool = Pool(processes)
+    try:
+        results = pool.map(read_stacked_dos, args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    nproj = max([0] + [len(data) for data, meta in results if data is not None])
+    stack = np.empty((len(results), nproj, len(grid)), dtype=dtype)
+    stack.fill(np.nan)
+    for i, (data, meta) in enumerate(results):
+        if data is not None:
+            stack[i, :len(data)] = data
+
+    return grid, stack, [meta for data, meta in results]
@@ -0,0 +1,93 @@
+# Copyright (C) 2013 - Zhongnan Xu
+"""This module contains functions for putting densities of states on a
+common energy grid and broadening them. All of them work on arrays of many
+densities at once, with energy along the last axis.
+"""
+
+import numpy as np
+
+def get_energy_grid(emin, emax, de=0.01):
+    '''Returns an evenly spaced energy grid from emin to emax (inclusive)
+    with a spacing of de'''
+
+    npoints = int(round((emax - emin) / de)) + 1
+    return np.linspace(emin, emax, npoints)
+
+def resample_dos(energies, dos, grid):
+    '''Linearly interpolates densities of states onto a new energy grid.
+
+    energies (array): The increasing energies the densities are given on
+
+    dos (array): The densities, with energy along the last axis. Any number
+                 of leading dimensions (projections, spins, ...) is allowed.
+
+    grid (array): The energies to interpolate onto. Points outside of
+                  energies are set to zero.
+
+    The interpolation weights are computed once and applied to all of
+    the densities together.'''
+
+    energies = np.asarray(energies, dtype=float)
+    grid = np.asarray(grid, dtype=float)
+    dos = np.asarray(dos)
+
+    # Index of the point above each grid point and the weight of it
+    upper = np.clip(np.searchsorted(energies, grid), 1, len(energies) - 1)
+    lower = upper - 1
+    weight = (grid - energies[lower]) / (energies[upper] - energies[lower])
+    outside = (grid < energies[0]) | (grid > energies[-1])
+    weight[outside] = 0.
+
+    resampled = dos[..., lower] * (1 - weight) + dos[..., upper] * weight
+    resampled[..., outside] = 0.
+
+    return resampled
+
+def broaden_dos(grid, dos, width, kind='gaussian'):
+    '''Broadens densities of states on an evenly spaced grid by convolving
+    them with a normalized Gaussian or Lorentzian.
+
+    grid (array): The evenly spaced energies of the densities, for example
+                  from get_energy_grid()
+
+    dos (array): The densities, with energy along the last axis
+
+    width (float): The standard deviation of the Gaussian or the half width
+                   at half maximum of the Lorentzian, in the units of grid
+
+    kind (string): 'gaussian' or 'lorentzian'
+
+    The convolution is done with FFTs along the last axis for all of the
+    densities at once. The densities are padded with zeros so that states
+    near one end of the grid do not leak into the other end. The number of
+    states is conserved up to what is broadened beyond the ends of the grid.'''
+
+    grid = np.asarray(grid, dtype=float)
+    dos = np.asarray(dos, dtype=float)
+    if width == None or width <= 0:
+        return dos.copy()
+
+    npoints = dos.shape[-1]
+    de = (grid[-1] - grid[0]) / (npoints - 1)
+
+    # The Gaussian has practically vanished after 6 standard deviations,
+    # the tails of the Lorentzian need as much padding as there is grid
+    if kind == 'gaussian':
+        npad = min(npoints, int(np.ceil(6 * width / de)))
+    elif kind == 'lorentzian':
+        npad = npoints
+    else:
+        raise ValueError('kind can only be gaussian or lorentzian')
+    nfft = 2 ** int(np.ceil(np.log2(npoints + npad)))
+
+    # The Fourier transforms of the normalized kernels are known analytically
+    omega = 2 * np.pi * np.fft.rfftfreq(nfft, d=de)
+    if kind == 'gaussian':
+        kernel = np.exp(-0.5 * (width * omega) ** 2)
+    else:
+        kernel = np.exp(-width * omega)
+
+    broadened = np.fft.irfft(np.fft.rfft(dos, n=nfft, axis=-1) * kernel,
+                             n=nfft, axis=-1)
+
+    return broadened[..., :npoints]
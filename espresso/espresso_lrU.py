@@ -3,14 +3,95 @@
 """
 
 from espresso import *
+from espresso_stage import *
 
 #################################
 ## Linear response U functions ##
 #################################
+
+# With alphas='adaptive' the perturbations in ADAPTIVE_ALPHAS[0] are run
+# first. The ones in ADAPTIVE_ALPHAS[1] are only added when the relative
+# standard error of the bare or converged slope is above ADAPTIVE_TOL.
+ADAPTIVE_ALPHAS = ((-0.07, 0, 0.07), (-0.15, 0.15))
+ADAPTIVE_TOL = 0.02
         
+def get_equivalent_sites(self, indexes=None, tol=0.05):
+    '''Returns the patoms dictionary of the Hubbard atoms, the ones with a
+    Hubbard_U or Hubbard_alpha, grouped into equivalent sites by
+    find_equivalent_sites. Atoms are only equivalent if they have the same
+    symbol, sign of the magnetic moment and Hubbard_U.'''
+
+    atoms = self.atoms
+    natoms = len(atoms)
+    Hubbard_U = self.list_params['Hubbard_U']
+    Hubbard_alpha = self.list_params['Hubbard_alpha']
+    if Hubbard_U is None:
+        Hubbard_U = np.zeros(natoms)
+    if Hubbard_alpha is None:
+        Hubbard_alpha = np.zeros(natoms)
+
+    if indexes is None:
+        indexes = [i for i in range(natoms)
+                   if Hubbard_U[i] != 0 or Hubbard_alpha[i] != 0]
+    if len(indexes) == 0:
+        raise ValueError('There are no atoms with a Hubbard_U or Hubbard_alpha')
+
+    magmoms = atoms.get_initial_magnetic_moments()
+    if magmoms.ndim == 1:
+        spins = np.sign(magmoms)
+    else:
+        spins = [tuple(np.round(m, 3)) for m in magmoms]
+    labels = [(symbol, spin, U) for symbol, spin, U in
+              zip(atoms.get_chemical_symbols(), spins, Hubbard_U)]
+
+    return find_equivalent_sites(labels, atoms.get_scaled_positions(),
+                                 atoms.get_cell(), indexes=indexes, tol=tol)
+
+Espresso.get_equivalent_sites = get_equivalent_sites
+
+def get_perturbed_atoms(self, patoms=None):
+    '''Returns patoms, or the one found by get_equivalent_sites if it is
+    None. That one is kept, because initialize_lrU re-sorts the atoms and
+    later calls have to use the indexes of the original order.'''
+
+    if patoms is not None:
+        return patoms
+    if getattr(self, 'patoms', None) is None:
+        self.patoms = self.get_equivalent_sites()
+
+    return self.patoms
+
+Espresso.get_perturbed_atoms = get_perturbed_atoms
+
+def unsort_lrU(self):
+    '''Puts the atoms and the Hubbard_alpha and Hubbard_U parameters back
+    in the order they were in before initialize_lrU sorted them'''
+
+    sort = getattr(self, 'lrU_sort', None)
+    if sort is None:
+        return
+
+    unsort = list(np.argsort(sort))
+    self.atoms = self.atoms[unsort]
+    Hubbard_alpha = self.list_params['Hubbard_alpha']
+    Hubbard_U = self.list_params['Hubbard_U']
+    self.list_params['Hubbard_alpha'] = [Hubbard_alpha[i] for i in unsort]
+    self.list_params['Hubbard_U'] = [Hubbard_U[i] for i in unsort]
+    self.lrU_sort = None
+
+    return
+
+Espresso.unsort_lrU = unsort_lrU
+
 def initialize_lrU(self, patoms):
     '''The purpose of this initialize function is to re-order the atoms
-    object so that it can be run in a linear response calculation'''
+    object so that it can be run in a linear response calculation.
+
+    The sort is kept in self.lrU_sort. Calling this again, as calc_Us does
+    after run_scf, first undoes the previous sort, so the indexes in patoms
+    always refer to the original order of the atoms.'''
+
+    self.unsort_lrU()
 
     # We first want to re-sort the atoms so that unique atoms are grouped together
     # and the non-unique atoms are at the back
@@ -33,12 +114,13 @@ def initialize_lrU(self, patoms):
     Hubbard_U = self.list_params['Hubbard_U']
     self.list_params['Hubbard_alpha'] = [Hubbard_alpha[i] for i in sort]
     self.list_params['Hubbard_U'] = [Hubbard_U[i] for i in sort]
+    self.lrU_sort = sort
 
     return sort
 
 Espresso.initialize_lrU = initialize_lrU
     
-def run_scf(self, patoms, center=True):
+def run_scf(self, patoms=None, center=True):
     '''The purpose of this function is to create separate folders for each
     atom that one needs to perturb and then run the self-consistent calculations.
     A couple of things this function needs to do...
@@ -47,8 +129,12 @@ def run_scf(self, patoms, center=True):
     2. Re-organize the atoms so that the different 'types' are grouped together
        with the perturbed atom at the first
     3. Create different folders for each scf calculation and future perturbation
-       calculations.'''
+       calculations.
+
+    If patoms is None, the Hubbard atoms are grouped into equivalent sites
+    automatically, see get_equivalent_sites.'''
 
+    patoms = self.get_perturbed_atoms(patoms)
     atoms = self.get_atoms()
     indexes = range(len(atoms))
     keys = sorted(patoms.keys())
@@ -95,9 +181,10 @@ def run_scf(self, patoms, center=True):
 
 Espresso.run_scf = run_scf
     
-def run_perts(self, indexes, alphas=(-0.15, -0.07, 0, 0.07, 0.15), test=False):
+def run_perts(self, indexes, alphas=(-0.15, -0.07, 0, 0.07, 0.15), test=False, mode=None):
     '''The purpose of this to to run perturbations following the scf
-    calculations that were run with the self.run_scf command.'''
+    calculations that were run with the self.run_scf command. See run_pert
+    for the modes of running them.'''
 
     calc_name = os.path.basename(self.espressodir)
     cwd = os.getcwd()
@@ -110,19 +197,270 @@ def run_perts(self, indexes, alphas=(-0.15, -0.07, 0, 0.07, 0.15), test=False):
             os.chdir(cwd)
             continue
         self.run_params['jobname']  = calc_name + '-{0:d}'.format(i)
-        if not self.run_pert(alphas=alphas, index=ind, test=test):
+        if not self.run_pert(alphas=alphas, index=ind, test=test, mode=mode):
             ready = False
         os.chdir(cwd)
     return ready
 
 Espresso.run_perts = run_perts
     
-def calc_Us(self, patoms, alphas=(-0.15, -0.07, 0, 0.07, 0.15), test=False, sc=1):
+def read_occupations(fname):
+    '''Reads the occupations of the Hubbard atoms from the output of a
+    perturbation in one pass. The initial occupations are the first ones
+    printed after the self-consistent calculation starts, and the final
+    occupations are the first ones printed after it ends.
+
+    Returns the indices of the atoms, starting at 0, in the order pw.x
+    prints them, and arrays of their initial and final occupations.'''
+
+    text = open(fname, 'r').read()
+    start = re.search('^     Self', text, re.M).start()
+    end = re.search('^     End', text, re.M).start()
+    pattern = re.compile('^atom +([0-9]+).*?(\S+)[ \t]*$', re.M)
+
+    def first_block(matches):
+        atoms, occs = [], []
+        for atom, occ in matches:
+            if int(atom) - 1 in atoms:
+                break
+            atoms.append(int(atom) - 1)
+            occs.append(float(occ))
+        return atoms, occs
+
+    atoms, occ_0s = first_block(pattern.findall(text, start, end))
+    atoms_f, occ_fs = first_block(pattern.findall(text, end))
+
+    return np.array(atoms), np.array(occ_0s), np.array(occ_fs)
+
+def get_occupations(self, alphas, results='results'):
+    '''Returns the indices of the Hubbard atoms and the initial and final
+    occupations of the perturbations in results/alpha_[alpha].out as two
+    arrays of shape (alphas, atoms).
+
+    The occupations are kept in results/occupations.npz and only read from
+    the outputs again when the alphas or the modification times of the
+    outputs have changed.'''
+
+    fnames = [os.path.join(results, 'alpha_{0}.out'.format(alpha)) for alpha in alphas]
+    mtimes = np.array([os.path.getmtime(fname) for fname in fnames])
+    cache_name = os.path.join(results, 'occupations.npz')
+
+    if os.path.exists(cache_name):
+        cache = np.load(cache_name)
+        if (np.array_equal(cache['alphas'], np.array(alphas, dtype=float))
+            and np.array_equal(cache['mtimes'], mtimes)):
+            return cache['atoms'], cache['occ_0'], cache['occ_f']
+
+    occ_0, occ_f = [], []
+    for fname in fnames:
+        atoms, occ_0s, occ_fs = read_occupations(fname)
+        occ_0.append(occ_0s)
+        occ_f.append(occ_fs)
+    occ_0, occ_f = np.array(occ_0), np.array(occ_f)
+
+    np.savez(cache_name, alphas=np.array(alphas, dtype=float), mtimes=mtimes,
+             atoms=atoms, occ_0=occ_0, occ_f=occ_f)
+
+    return atoms, occ_0, occ_f
+
+Espresso.get_occupations = get_occupations
+
+def get_pert_alphas(self, alphas='adaptive', results='results'):
+    '''Returns the perturbations to use in the current perturbation
+    directory. Anything but 'adaptive' is returned as it is.
+
+    For 'adaptive', the first set of ADAPTIVE_ALPHAS is returned until
+    those calculations are finished. Then the response of the perturbed
+    atom, the one with the largest bare response, is fitted. The rest of
+    ADAPTIVE_ALPHAS is added if the response is not linear enough, or if
+    those calculations have already been done.'''
+
+    if alphas != 'adaptive':
+        return alphas
+
+    alphas, extra_alphas = ADAPTIVE_ALPHAS
+    for alpha in alphas:
+        fname = os.path.join(results, 'alpha_{0}.out'.format(alpha))
+        if not self.check_calc_complete(filename=fname):
+            return alphas
+
+    all_alphas = tuple(sorted(alphas + extra_alphas))
+    for alpha in extra_alphas:
+        fname = os.path.join(results, 'alpha_{0}.out'.format(alpha))
+        if os.path.exists(fname):
+            return all_alphas
+
+    atoms, occ_0, occ_f = self.get_occupations(alphas, results)
+    column = np.argmax(np.abs(fit_response_slopes(alphas, occ_0)[0]))
+    slopes, errors = fit_response_slopes(alphas, np.column_stack([occ_0[:, column],
+                                                                  occ_f[:, column]]))
+    if (errors / np.abs(slopes)).max() > ADAPTIVE_TOL:
+        return all_alphas
+
+    return alphas
+
+Espresso.get_pert_alphas = get_pert_alphas
+
+def get_periodic_distances(scaled_positions, cell):
+    '''Returns the matrix of the shortest distances between atoms,
+    taking the periodic images in the neighboring cells into account'''
+
+    vectors = scaled_positions[:, np.newaxis, :] - scaled_positions[np.newaxis, :, :]
+    vectors -= np.round(vectors)
+    images = np.array([(i, j, k) for i in (-1, 0, 1)
+                       for j in (-1, 0, 1) for k in (-1, 0, 1)])
+    vectors = vectors[:, :, np.newaxis, :] + images
+    return np.sqrt((np.dot(vectors, cell) ** 2).sum(axis=3)).min(axis=2)
+
+def find_equivalent_sites(labels, scaled_positions, cell, indexes=None, tol=0.05):
+    '''Groups the atoms in indexes, all of them by default, into sets of
+    equivalent sites. Every atom is fingerprinted by its sorted distances
+    to the atoms of each label, see get_periodic_distances. Two atoms are
+    equivalent if they have the same label and their fingerprints agree
+    within tol (Angstrom).
+
+    labels can be anything that tells atoms apart, for example the symbol
+    and the sign of the magnetic moment. Returns the groups as a patoms
+    dictionary, keyed by the first atom of each group.'''
+
+    labels = list(labels)
+    distances = get_periodic_distances(np.asarray(scaled_positions, dtype=float),
+                                       np.asarray(cell, dtype=float))
+    if indexes is None:
+        indexes = range(len(labels))
+
+    kinds = sorted(set(labels))
+    masks = [np.array([label == kind for label in labels]) for kind in kinds]
+
+    groups = []
+    for i in indexes:
+        fingerprint = np.concatenate([np.sort(distances[i][mask]) for mask in masks])
+        for label, reference, members in groups:
+            if label == labels[i] and np.abs(fingerprint - reference).max() < tol:
+                members.append(i)
+                break
+        else:
+            groups.append((labels[i], fingerprint, [i]))
+
+    return dict([(members[0], members) for label, fingerprint, members in groups])
+
+def fill_response_matrix(chi, perturbed, types, magmoms, distances):
+    '''Fills in the columns of a response matrix for atoms that were not
+    perturbed themselves. chi[I, J] is the change in occupation of atom I
+    per eV of perturbation on atom J, and only the columns in perturbed,
+    one per type, have been calculated.
+
+    The response of atom I to an atom J of the same type as the perturbed
+    atom P is taken from the atom K of the same type as I that sits at the
+    same distance from P as I does from J. With magnetic moments, K and P
+    also have to be aligned the same way as I and J.'''
+
+    chi = np.array(chi, dtype=float)
+    types = np.asarray(types)
+    signs = np.sign(magmoms)
+    for J in range(len(chi)):
+        P = perturbed[types[J]]
+        if J == P:
+            continue
+        for I in range(len(chi)):
+            candidates = np.where((types == types[I])
+                                  & (signs * signs[P] == signs[I] * signs[J]))[0]
+            if len(candidates) == 0:
+                candidates = np.where(types == types[I])[0]
+            K = candidates[np.argmin(np.abs(distances[candidates, P] - distances[I, J]))]
+            chi[I, J] = chi[K, P]
+    return chi
+
+def expand_response_matrix(chi, scaled_positions, cell, sc=1, tol=1e-3):
+    '''Extrapolates a response matrix to a supercell of sc x sc x sc cells.
+
+    In the calculation every atom responds to the perturbation of all of the
+    periodic images of an atom. In the supercell this response is given to
+    the closest images only, and shared between them if several are equally
+    close. The atoms of the original cell are the first ones of the
+    supercell matrix.'''
+
+    if sc == 1:
+        return chi
+
+    natoms = len(chi)
+    translations = np.array([(i, j, k) for i in range(sc)
+                             for j in range(sc) for k in range(sc)])
+    positions = ((scaled_positions[np.newaxis, :, :] + translations[:, np.newaxis, :])
+                 / float(sc)).reshape(-1, 3)
+    distances = get_periodic_distances(positions, np.asarray(cell) * sc)
+    small = np.tile(get_periodic_distances(scaled_positions, cell), (sc ** 3, sc ** 3))
+
+    closest = np.abs(distances - small) < tol
+    # The number of images of each atom that are closest to each atom
+    counts = closest.reshape(len(positions), sc ** 3, natoms).sum(axis=1)
+    counts = np.tile(counts, (1, sc ** 3))
+    return np.where(closest, np.tile(chi, (sc ** 3, sc ** 3)) / np.maximum(counts, 1), 0.)
+
+def fit_response_slopes(alphas, occupations):
+    '''Fits straight lines to the occupations of many atoms against the
+    perturbation alpha with a single least squares solve. occupations has
+    a row for each alpha and any number of columns, for example the bare
+    and converged occupations of all atoms side by side.
+
+    Returns the slopes of the columns and their standard errors.'''
+
+    alphas = np.asarray(alphas, dtype=float)
+    occupations = np.asarray(occupations, dtype=float)
+    x = np.column_stack([np.ones(len(alphas)), alphas])
+    coefs, residuals, rank, sv = np.linalg.lstsq(x, occupations, rcond=-1)
+
+    # The residuals are not returned for exact fits, so compute them
+    residuals = ((occupations - np.dot(x, coefs)) ** 2).sum(axis=0)
+    if len(alphas) > 2:
+        variance = residuals / (len(alphas) - 2)
+    else:
+        variance = np.zeros(residuals.shape)
+    errors = np.sqrt(variance * np.linalg.inv(np.dot(x.T, x))[1, 1])
+
+    return coefs[1], errors
+
+def get_response_Us(chi0, chi, perturbed, chi0_errors=None, chi_errors=None):
+    '''Returns the Hubbard U of the perturbed atoms from the bare and
+    converged response matrices, the diagonal of inv(chi0) - inv(chi).
+
+    If the standard errors of the matrix elements are given, the
+    uncertainties of the Us are returned too. They are propagated to first
+    order treating the elements as independent.'''
+
+    inv_chi0, inv_chi = np.linalg.inv(chi0), np.linalg.inv(chi)
+    Us = np.array([inv_chi0[P, P] - inv_chi[P, P] for P in perturbed])
+    if chi0_errors is None or chi_errors is None:
+        return Us
+
+    # d inv(A)_PP / d A_ij = -inv(A)_Pi inv(A)_jP
+    errors = []
+    for P in perturbed:
+        var0 = ((np.outer(inv_chi0[P], inv_chi0[:, P]) * chi0_errors) ** 2).sum()
+        var = ((np.outer(inv_chi[P], inv_chi[:, P]) * chi_errors) ** 2).sum()
+        errors.append(np.sqrt(var0 + var))
+
+    return Us, np.array(errors)
+
+def calc_Us(self, patoms=None, alphas=(-0.15, -0.07, 0, 0.07, 0.15), test=False, sc=1,
+            solver='numpy'):
     '''The purpose of this program is to take the data out of the
-    already run calculations and feed it to the r.x program, which
-    calculates the linear response U. This function can calculate Us
-    in systems with multiple atoms perturbed'''
+    already run calculations and calculate the linear response U. This
+    function can calculate Us in systems with multiple atoms perturbed.
+
+    With solver='numpy' the response matrices are built and inverted here,
+    see fill_response_matrix and expand_response_matrix, and the Us are
+    returned. With solver='rx' the input files of the r.x program are
+    written and it is run. Either way the Us are written to Ucalc/Umat.out
+    to be read by read_Us.
 
+    The numpy solver returns the Us and their uncertainties, propagated
+    from the standard errors of the fitted slopes.
+
+    With alphas='adaptive' every perturbation directory uses the alphas
+    chosen by get_pert_alphas. r.x needs the same number in all of them.'''
+
+    patoms = self.get_perturbed_atoms(patoms)
     sort = self.initialize_lrU(patoms)
     calc_name = os.path.basename(self.espressodir)
 
@@ -135,65 +473,68 @@ def calc_Us(self, patoms, alphas=(-0.15, -0.07, 0, 0.07, 0.15), test=False, sc=1
         for index in patoms[key]:
             allatoms.append(index)
 
+    natoms = len(allatoms)
+    chi0, chi = np.zeros((natoms, natoms)), np.zeros((natoms, natoms))
+    chi0_errors, chi_errors = np.zeros((natoms, natoms)), np.zeros((natoms, natoms))
+    perturbed = [sort.index(key) for key in keys]
+
     cwd = os.getcwd()
+    nalphas = []
     for i, key in enumerate(keys):
         os.chdir(calc_name + '-{0:d}-pert'.format(i + 1))
+        pert_alphas = self.get_pert_alphas(alphas)
+        nalphas.append(len(pert_alphas))
         # First assert that the calculations are done            
-        for alpha in alphas:
+        for alpha in pert_alphas:
             assert isfile('results/alpha_{0}.out'.format(alpha))
             assert self.check_calc_complete(filename='results/alpha_{0}.out'.format(alpha))
-                # Create the arrays for storing the atom and their occupancies
-        alpha_0s, alpha_fs = [], []
 
         # Store the initial and final occupations in arrays
-        for alpha in alphas:
-            occ_0s, occ_fs = [], []
-            outfile = open('results/alpha_{0}.out'.format(alpha))
-            lines = outfile.readlines()
-            calc_started = False
-            calc_finished = False
-            for line in lines:
-                # We first want to read the initial occupancies. This happens after
-                # the calculation starts.
-                if line.startswith('     Self'):
-                    calc_started = True
-                if line.startswith('     End'):
-                    calc_finished = True
-                # We will first 
-                if not line.startswith('atom '):
-                    continue
-                occ = float(line.split()[-1])
-                if calc_started == True and calc_finished == False:
-                    occ_0s.append(occ)
-                elif calc_finished == True:
-                    occ_fs.append(occ)
-                else:
-                    continue
-            alpha_0s.append(occ_0s)
-            alpha_fs.append(occ_fs)
+        atoms, alpha_0s, alpha_fs = self.get_occupations(pert_alphas)
+        os.chdir(cwd)
+
+        if solver == 'numpy':
+            slopes, errors = fit_response_slopes(pert_alphas, np.hstack([alpha_0s[:, :natoms],
+                                                                    alpha_fs[:, :natoms]]))
+            chi0[:, sort.index(key)], chi[:, sort.index(key)] = np.split(slopes, 2)
+            chi0_errors[:, sort.index(key)], chi_errors[:, sort.index(key)] = np.split(errors, 2)
+            continue
 
         # Write out the dn files
-        os.chdir(cwd)
         dnda = open('Ucalc/dnda', 'a')
         for atom in range(len(allatoms)):
-            list_0, list_f = [], []
-            for i, alpha in enumerate(alphas):
-                list_0.append(alpha_0s[i][atom])
-                list_f.append(alpha_fs[i][atom])
+            list_0, list_f = alpha_0s[:, atom], alpha_fs[:, atom]
             dn0_file = open('Ucalc/dn0.{0}.da.{1}.dat'.format(atom + 1,
                                                               sort.index(key) + 1), 'w')
-            for alpha, occ in zip(alphas, list_0):
+            for alpha, occ in zip(pert_alphas, list_0):
                 dn0_file.write(' {alpha}  {occ}\n'.format(**locals()))
             dn0_file.close()
             dn_file = open('Ucalc/dn.{0}.da.{1}.dat'.format(atom + 1,
                                                             sort.index(key) + 1), 'w')
-            for alpha, occ in zip(alphas, list_f):
+            for alpha, occ in zip(pert_alphas, list_f):
                 dn_file.write(' {alpha}  {occ}\n'.format(**locals()))
             dn_file.close()
             dnda_filename = 'dn.{0}.da.{1}.dat dn0.{0}.da.{1}.dat\n'
             dnda.write(dnda_filename.format(atom + 1, sort.index(key) + 1))
         dnda.close()
 
+    if solver == 'numpy':
+        types = [i for i, key in enumerate(keys) for index in patoms[key]]
+        positions = self.atoms.get_scaled_positions()[:natoms]
+        magmoms = self.atoms.get_initial_magnetic_moments()[:natoms]
+        distances = get_periodic_distances(positions, self.atoms.get_cell())
+        matrices = []
+        for matrix in (chi0, chi, chi0_errors, chi_errors):
+            matrix = fill_response_matrix(matrix, perturbed, types, magmoms, distances)
+            matrices.append(expand_response_matrix(matrix, positions, self.atoms.get_cell(), sc))
+        Us, errors = get_response_Us(*([matrices[0], matrices[1], perturbed] + matrices[2:]))
+
+        Umat = open('Ucalc/Umat.out', 'w')
+        for i, U in enumerate(Us):
+            Umat.write('  type: {0:3d}  U = {1:12.6f}\n'.format(i + 1, U))
+        Umat.close()
+        return Us, errors
+
     # Write out the pos files
     pos_file = open('Ucalc/pos', 'w')
     for vec in self.atoms.cell:
@@ -219,7 +560,9 @@ def calc_Us(self, patoms, alphas=(-0.15, -0.07, 0, 0.07, 0.15), test=False, sc=1
     rxinput.write('  ntyp = {0}\n'.format(len(keys)))
     for i, key in enumerate(keys):
         rxinput.write('  na({0}) = {1}\n'.format(i + 1, len(patoms[key])))
-    rxinput.write('  nalfa = {0:d}\n'.format(len(alphas)))
+    if len(set(nalphas)) > 1:
+        raise ValueError('r.x needs the same number of alphas for every perturbation')
+    rxinput.write('  nalfa = {0:d}\n'.format(nalphas[0]))
     rxinput.write('  magn = .True.\n')
     rxinput.write("  filepos = 'pos'\n")
     rxinput.write("  back = 'no'\n")
@@ -243,9 +586,12 @@ def calc_Us(self, patoms, alphas=(-0.15, -0.07, 0, 0.07, 0.15), test=False, sc=1
 Espresso.calc_Us = calc_Us
 
 def python_calc_single_U(self, key, alphas=(-0.15, -0.07, 0, 0.07, 0.15)):
-    '''This is a function to calculate the linear response U of a single atom'''
+    '''This is a function to calculate the linear response U of a single atom.
+    Returns the U as a ufloat. Its uncertainty is the standard error
+    propagated to first order from the standard errors of the fitted
+    slopes, see get_single_site_Us, not the half width of the 95%
+    confidence interval it used to be.'''
 
-    from pycse import regress
     from uncertainties import ufloat
     calc_name = os.path.basename(self.espressodir)
 
@@ -255,55 +601,75 @@ def python_calc_single_U(self, key, alphas=(-0.15, -0.07, 0, 0.07, 0.15)):
     cwd = os.getcwd()
 
     os.chdir(calc_name + '-1-pert')
+    alphas = self.get_pert_alphas(alphas)
     # First assert that the calculations are done            
     for alpha in alphas:
         assert isfile('results/alpha_{0}.out'.format(alpha))
         assert self.check_calc_complete(filename='results/alpha_{0}.out'.format(alpha))
 
-    # First create the matrix for storing occupancies
-    occ_0s, occ_fs = [], []
-
-    # Store the initial and final occupations in arrays
-    for alpha in alphas:
-        outfile = open('results/alpha_{0}.out'.format(alpha))
-        lines = outfile.readlines()
-        calc_started = False
-        calc_finished = False
-        for line in lines:
-            # We first want to read the initial occupancies. This happens after
-            # the calculation starts.
-            if line.startswith('     Self'):
-                calc_started = True
-            if line.startswith('     End'):
-                calc_finished = True
-            # We will first 
-            if not line.startswith('atom '):
-                continue
-            if not int(line.split()[1]) == key + 1:
-                continue
-            occ = float(line.split()[-1])
-            if calc_started == True and calc_finished == False:
-                occ_0s.append(occ)
-            elif calc_finished == True:
-                occ_fs.append(occ)
-            else:
-                continue
+    # Store the initial and final occupations of the atom in arrays
+    atoms, alpha_0s, alpha_fs = self.get_occupations(alphas)
+    column = list(atoms).index(key)
+    occ_0s, occ_fs = alpha_0s[:, column], alpha_fs[:, column]
     os.chdir(cwd)
 
-    x = np.column_stack([np.array(alphas)**0, np.array(alphas)])
+    Us, errors = get_single_site_Us(alphas, occ_0s[:, np.newaxis], occ_fs[:, np.newaxis])
 
-    bare_slope, bare_uncert, bare_e = regress(x, occ_0s, 0.05)
-    convg_slope, convg_uncert, convg_e = regress(x, occ_fs, 0.05)
-    
-    bare_slope = ufloat(bare_slope[1], (abs(bare_uncert[1][0] - bare_uncert[1][1])) / 2)
-    convg_slope = ufloat(convg_slope[1], (abs(convg_uncert[1][0] - convg_uncert[1][1])) / 2)
-    
-    U =  1 / bare_slope - 1 / convg_slope
-
-    return U
+    return ufloat(Us[0], errors[0])
 
 Espresso.python_calc_single_U = python_calc_single_U
 
+def get_single_site_Us(alphas, occ_0s, occ_fs):
+    '''Returns the single site Us, 1 / chi0 - 1 / chi, of many atoms and
+    their uncertainties. occ_0s and occ_fs hold the bare and converged
+    occupations of each atom, in a column, responding to its own
+    perturbation. All of the slopes are fitted in one solve and the
+    standard errors are propagated to first order.'''
+
+    slopes, errors = fit_response_slopes(alphas, np.hstack([occ_0s, occ_fs]))
+    chi0, chi = np.split(slopes, 2)
+    chi0_errors, chi_errors = np.split(errors, 2)
+    Us = 1 / chi0 - 1 / chi
+    errors = np.sqrt((chi0_errors / chi0 ** 2) ** 2 + (chi_errors / chi ** 2) ** 2)
+
+    return Us, errors
+
+def python_calc_Us(self, patoms=None, alphas=(-0.15, -0.07, 0, 0.07, 0.15)):
+    '''Returns the single site Us of all of the perturbed atoms of a
+    calculation set up with run_scf, and their uncertainties, as arrays
+    in the order of the sorted keys of patoms. Only the response of each
+    perturbed atom to its own perturbation is used, see calc_Us for the
+    full response matrices.'''
+
+    patoms = self.get_perturbed_atoms(patoms)
+    sort = self.initialize_lrU(patoms)
+    calc_name = os.path.basename(self.espressodir)
+    keys = sorted(patoms.keys())
+
+    # Perturbations with the same alphas are fitted together
+    groups = {}
+    cwd = os.getcwd()
+    for i, key in enumerate(keys):
+        os.chdir(calc_name + '-{0:d}-pert'.format(i + 1))
+        pert_alphas = tuple(self.get_pert_alphas(alphas))
+        for alpha in pert_alphas:
+            assert self.check_calc_complete(filename='results/alpha_{0}.out'.format(alpha))
+        atoms, alpha_0s, alpha_fs = self.get_occupations(pert_alphas)
+        os.chdir(cwd)
+        groups.setdefault(pert_alphas, []).append((i, alpha_0s[:, sort.index(key)],
+                                                   alpha_fs[:, sort.index(key)]))
+
+    Us, errors = np.empty(len(keys)), np.empty(len(keys))
+    for pert_alphas, group in groups.items():
+        indexes, occ_0s, occ_fs = zip(*group)
+        U, error = get_single_site_Us(pert_alphas, np.column_stack(occ_0s),
+                                      np.column_stack(occ_fs))
+        Us[list(indexes)], errors[list(indexes)] = U, error
+
+    return Us, errors
+
+Espresso.python_calc_Us = python_calc_Us
+
 def write_pert(self, alphas=(-0.15, -0.07, 0.0, 0.07, 0.15,), index=1, parallel=False):
     '''The purpose of this function is to calculate the linear response U
     after a self-consistent calculation has already been done. Some notes:
@@ -365,7 +731,9 @@ def write_pert(self, alphas=(-0.15, -0.07, 0.0, 0.07, 0.15,), index=1, parallel=
             if line.split()[0].lower() == '&control':
                 new_file.write(line)
                 new_file.write(" disk_io = 'none'\n")
-                new_file.write(" outdir = '{0}'\n".format(self.string_params['outdir']))
+                new_file.write(" wf_collect = .false.\n")
+                new_file.write(" outdir = '{0}/alpha_{1}'\n".format(self.string_params['outdir'],
+                                                                     alpha))
                 new_file.write(" wfcdir = './'\n")
             elif line.split()[0].lower() == '&electrons':
                 new_file.write(line)
@@ -377,7 +745,10 @@ def write_pert(self, alphas=(-0.15, -0.07, 0.0, 0.07, 0.15,), index=1, parallel=
                                                                     alpha))
             elif (line.split()[0].lower() == 'wfcdir' 
                   or line.split()[0].lower() == 'outdir'
-                  or line.split()[0].lower() == 'disk_io'):
+                  or line.split()[0].lower() == 'disk_io'
+                  or line.split()[0].lower() == 'wf_collect'
+                  or line.split()[0].lower() == 'startingwfc'
+                  or line.split()[0].lower() == 'startingpot'):
                 continue
             else:
                 new_file.write(line)
@@ -386,14 +757,41 @@ def write_pert(self, alphas=(-0.15, -0.07, 0.0, 0.07, 0.15,), index=1, parallel=
 
 Espresso.write_pert = write_pert
     
-def run_pert(self, alphas=(-0.15, -0.07, 0, 0.07, 0.15), index=1, test=False):
+def run_pert(self, alphas=(-0.15, -0.07, 0, 0.07, 0.15), index=1, test=False, mode=None):
     '''Now we create the runscript that performs the calculations. This will
     be tricky because we need to write a script that copies the saved files
     from the previous calculation to be used in these perturbation calculations.
     Also note that index in this case is the index, starting at 1, of the unique
     atom that is to be perturbed.
+
+    With alphas='adaptive' the perturbations are chosen by get_pert_alphas.
+
+    mode sets how the perturbations are run, by default run_params['pert_mode'].
+
+    serial: One job runs the perturbations one after the other on all of
+            the processors.
+    split:  One job runs the perturbations at the same time, splitting the
+            processors between them. If there are more perturbations than
+            processors they are run in rounds. The runs are not placed on
+            hosts, so this is only for jobs on one node.
+    array:  A job array with a job for each perturbation, each with the
+            nodes and processors in run_params.
+
+    The restart data of the self-consistent calculation is staged once into
+    [outdir]/scf and every perturbation runs in [outdir]/alpha_[alpha] with
+    hardlinks to it. Only the wavefunctions are shared, pw.x gets copies of
+    the files it writes to. The job stops if the shared data changes, and
+    the shared wavefunctions are not staged back into alpha_[alpha].
     '''
 
+    if mode == None:
+        mode = self.run_params['pert_mode']
+    if mode not in ('serial', 'split', 'array'):
+        raise ValueError('mode can only be serial, split or array')
+    if mode == 'split' and self.run_params['nodes'] > 1:
+        raise ValueError('split mode only runs on one node, use array mode for more')
+
+    alphas = self.get_pert_alphas(alphas)
     run_alphas = self.write_pert(alphas=alphas, index=index, parallel=False)
     if run_alphas == None:
         return True
@@ -406,91 +804,95 @@ def run_pert(self, alphas=(-0.15, -0.07, 0, 0.07, 0.15), index=1, test=False):
                                   self.run_params['jobname'] + '-pert')
     run_file_name = self.filename + '.pert.run'
     np = self.run_params['nodes'] * self.run_params['ppn']
-    
-    rundir =  self.run_params['rundir']
-    mpicmd =  self.run_params['mpicmd']
 
-    # Start the run script
     if self.run_params['qsys'] == 'pbs':
-        qtype='PBS'
-        npflag='-np'
-        subcmd='qsub'
-        subdir='$PBS_O_WORKDIR'
-        script = '''#!/bin/bash
-#PBS -l walltime={0}
-#PBS -j oe
-#PBS -N {1}
-'''.format(self.run_params['walltime'], self.run_params['jobname'])
-    else:
-        qtype='SLURM'
-        npflag='-n'
-        subcmd='sbatch'
-        subdir='$SLURM_SUBMIT_DIR'
-        script = '''#!/bin/bash
-#SBATCH --time={0}
-#SBATCH --job-name={1}
-'''.format(self.run_params['walltime'], self.run_params['jobname'])
-
-    # Now add pieces to the script depending on whether we need to
-    # pick the processor or the memory
-    if self.run_params['processor'] == None:
-        if self.run_params['qsys'] == 'pbs':
-            s = '#PBS -l nodes={0:d}:ppn={1:d}\n'
-            script += s.format(self.run_params['nodes'],
-                               self.run_params['ppn'])
-        else:
-            s = '#SBATCH --nodes={0:d} --ntasks-per-node={1:d}\n'
-            script += s.format(self.run_params['nodes'], 
-                               self.run_params['ppn'])
+        qtype = 'PBS'
+        array_id = '$PBS_ARRAYID'
     else:
-        if self.run_params['qsys'] == 'pbs':
-            s = '#PBS -l nodes={0:d}:ppn={1:d}:{2}\n'
-            script += s.format(self.run_params['nodes'],
-                               self.run_params['ppn'],
-                               self.run_params['processor'])
-        else:
-            s = '#SBATCH --nodes={0:d} --ntasks-per-node={1:d} --nodelist={2}\n'
-            script += s.format(self.run_params['nodes'],
-                               self.run_params['ppn'],
-                               self.run_params['processor'])
-        
-    if self.run_params['mem'] != None:
-        if self.run_params['qsys'] == 'pbs':
-            s = '#PBS -l mem={0}\n'
-            script += s.format(self.run_params['mem'])
-        else:
-            s = '#SBATCH --mem-per-cpu={0}\n'
-            script += s.format(1024*int(self.run_params['mem'].lower().split('gb')[0]))
+        qtype = 'SLURM'
+        array_id = '$SLURM_ARRAY_TASK_ID'
 
-    if self.run_params['queue'] != None:
-        if self.run_params['qsys'] == 'pbs':
-            script += '#PBS -q {0}\n'.format(self.run_params['queue'])
-        else:
-            script += '#SBATCH -p {0}\n'.format(self.run_params['queue'])
-
-    # Now add the parts of the script for running calculations
-    script += '''\ncd {0}\n'''.format(subdir)
-    
-    # we need to make the directory first
-    script += 'mkdir {0}\n'.format(self.string_params['outdir'])
+    if mode == 'array':
+        script, npflag, subcmd = self.get_script_header(self.run_params['jobname'],
+                                                        array=len(run_alphas))
+    else:
+        script, npflag, subcmd = self.get_script_header(self.run_params['jobname'])
 
     run_cmd = self.run_params['executable']
+    outdir = self.string_params['outdir']
 
-    for alpha in run_alphas:
-        script += '\ncp -r pwscf.occup pwscf.save {0}\n'.format(self.string_params['outdir'])
-        script += ("sed -i 's@${"+qtype+"_JOBID}@'${"+qtype+"_JOBID}'@' " 
-                   + 'alpha_{0}/alpha_{0}.in\n'.format(alpha))
-        if self.run_params['ppn'] == 1:
-            s = '{1} < alpha_{0}/alpha_{0}.in | tee results/alpha_{0}.out\n'
-            script += s.format(alpha, run_cmd)
-        else:
-            s = '{4} {5} {1:d} {2} -inp alpha_{0}/alpha_{0}.in -npool {3} | tee results/alpha_{0}.out\n'
-            script += s.format(alpha, np, run_cmd, self.run_params['pools'], 
-                               self.run_params['mpicmd'], npflag)
+    restart_files = ['pwscf.occup', 'pwscf.save']
+    shared = ' -o '.join(["-name '{0}'".format(p) for p in SHARED_FILES])
 
-        script += 'mv {1}/* alpha_{0}/\n'.format(alpha, self.string_params['outdir'])
+    def run_alpha(alpha, nodes, ppn, scf_dir, check, background=False):
+        '''Returns the lines of the script that run one perturbation'''
+        alpha_outdir = '{0}/alpha_{1}'.format(outdir, alpha)
+        # Runs in the background write to their output file only
+        if background == True:
+            out = '> results/alpha_{0}.out'.format(alpha)
+        else:
+            out = '| tee results/alpha_{0}.out'.format(alpha)
+        lines = stage_command(scf_dir, alpha_outdir, restart_files, link=True)
+        lines += unshare_command(alpha_outdir)
+        lines += ("sed -i 's@${"+qtype+"_JOBID}@'${"+qtype+"_JOBID}'@' " 
+                  + 'alpha_{0}/alpha_{0}.in\n'.format(alpha))
+        if nodes * ppn == 1:
+            s = '{1} < alpha_{0}/alpha_{0}.in {2}\n'
+            lines += s.format(alpha, run_cmd, out)
+        else:
+            # Runs in split mode only get a share of the processors, which
+            # fixed pools and ndiag need not fit
+            params = self.run_params.copy()
+            if background == True and self.run_params['pools'] != 'auto':
+                procs = nodes * ppn
+                npool = max([n for n in range(1, min(self.run_params['pools'], procs) + 1)
+                             if procs % n == 0])
+                self.run_params['pools'] = npool
+                if (self.run_params['ndiag'] is not None
+                    and self.run_params['ndiag'] > procs / npool):
+                    self.run_params['ndiag'] = 1
+            np, pw_flags = self.get_pw_flags(nodes=nodes, ppn=ppn)
+            self.run_params = params
+            s = '{4} {5} {1:d} {2} -inp alpha_{0}/alpha_{0}.in {3} {6}\n'
+            lines += s.format(alpha, np, run_cmd, pw_flags, 
+                              self.run_params['mpicmd'], npflag, out)
+        lines += check
+        lines += 'find {0} -type f -links +1 \\( {1} \\) -delete\n'.format(alpha_outdir, shared)
+        lines += stage_command(alpha_outdir, 'alpha_{0}'.format(alpha), ['*'], link=True)
+        lines += 'rm -fr {0}\n'.format(alpha_outdir)
+        if background == True:
+            lines = '(\n' + lines + ') &\n'
+        return '\n' + lines
+
+    if mode == 'array':
+        # Every job of the array picks its perturbation by its index and
+        # only cleans up after itself
+        script += '\nALPHAS=({0})\n'.format(' '.join([str(a) for a in run_alphas]))
+        script += 'alpha=${{ALPHAS[{0}]}}\n'.format(array_id)
+        scf_dir = '{0}/scf_$alpha'.format(outdir)
+    else:
+        scf_dir = '{0}/scf'.format(outdir)
+    script += stage_command('.', scf_dir, restart_files, link=True)
+    snapshot, check = snapshot_command(scf_dir, 'SCF_SNAPSHOT')
+    script += snapshot
+
+    nodes, ppn = self.run_params['nodes'], self.run_params['ppn']
+    if mode == 'serial':
+        for alpha in run_alphas:
+            script += run_alpha(alpha, nodes, ppn, scf_dir, check)
+    elif mode == 'split':
+        nruns = min(len(run_alphas), np)
+        for i in range(0, len(run_alphas), nruns):
+            for alpha in run_alphas[i:i + nruns]:
+                script += run_alpha(alpha, 1, np / nruns, scf_dir, check, background=True)
+            script += 'wait\n'
+    else:
+        script += run_alpha('$alpha', nodes, ppn, scf_dir, check)
 
-    script += 'rm -fr {0}\n'.format(self.string_params['outdir'])
+    if mode == 'array':
+        script += 'rm -fr {0}\n'.format(scf_dir)
+    else:
+        script += 'rm -fr {0}\n'.format(outdir)
     script += '# end\n'
     if test == True:
         print script
@@ -500,9 +902,9 @@ def run_pert(self, alphas=(-0.15, -0.07, 0, 0.07, 0.15), index=1, test=False):
     run_file.close()
 
     # Now just submit the calculations
-    p = Popen(['qsub', run_file_name], stdout=PIPE, stderr=PIPE)
+    p = Popen([subcmd, run_file_name], stdout=PIPE, stderr=PIPE)
 
-    out, err = p.communicate(script)
+    out, err = p.communicate()
     f = open('jobid', 'w')
     f.write(out)
     f.close()
@@ -535,12 +937,12 @@ def read_Us(self, f='Umat.out'):
 
 Espresso.read_Us = read_Us
 
-def get_linear_response_Us(self, patoms, center=True, alphas=(-0.15, -0.07, 0, 0.07, 0.15)):
+def get_linear_response_Us(self, patoms=None, center=True, alphas=(-0.15, -0.07, 0, 0.07, 0.15)):
     '''This is a convenience function that does all of the calculations needed to 
-    calculate the linear response U value'''
+    calculate the linear response U value. Without patoms the perturbed
+    atoms are found with get_equivalent_sites.'''
 
-    from pycse import regress
-    from uncertainties import ufloat
+    patoms = self.get_perturbed_atoms(patoms)
 
     # First try running the self-consistent calculation. If it is finished
     # it will return the indexes of the atoms (Quantum-Espresso format) that
@@ -568,39 +970,114 @@ def get_linear_response_Us(self, patoms, center=True, alphas=(-0.15, -0.07, 0, 0
 
 Espresso.get_linear_response_Us = get_linear_response_Us
 
-def run_pert_parallel(self, alphas=(-0.15, -0.07, 0, 0.07, 0.15), index=1, test=False):
-    '''This is a trial script to see if calculations can be done in parallel.
-    '''
-    run_alphas = self.write_pert(alphas=alphas, index=index, parallel=True)
-    run_cmd = self.run_params['executable']
-    for alpha in run_alphas:
-        script = '''#!/bin/bash
-cd $PBS_O_WORKDIR
-{0} < alpha_{1}.in | tee results/alpha_{1}.out
-# end
-'''.format(run_cmd, alpha)
-        if self.run_params['jobname'] == None:
-            self.run_params['jobname'] = self.espressodir + '-pert'
+def get_self_consistent_Us(self, patoms=None, center=True, alphas=(-0.15, -0.07, 0, 0.07, 0.15),
+                           tol=0.1, maxiter=10):
+    '''Iterates the linear response U to self-consistency. Every iteration
+    k runs get_linear_response_Us in the folder scU-[k] with the Us found
+    in the previous iteration applied to the perturbed atoms and their
+    equivalent atoms, until no U changes by more than tol (eV). The Us
+    of the calculator are the starting guess.
+
+    From the second iteration on the self-consistent calculations start
+    from the wavefunctions and charge density of the previous iteration,
+    which are hardlinked into their folders.
+
+    Like get_linear_response_Us this is meant to be run again until it is
+    done. It returns None while calculations are running and the converged
+    Us at the end. The Us each iteration started with are kept in
+    scU-[k]/U_in.'''
+
+    import copy
+
+    patoms = self.get_perturbed_atoms(patoms)
+    self.unsort_lrU()
+    atoms = self.atoms.copy()
+    list_params = copy.deepcopy(self.list_params)
+    string_params = copy.deepcopy(self.string_params)
+
+    def restore():
+        self.atoms = atoms.copy()
+        self.lrU_sort = None
+        self.list_params = copy.deepcopy(list_params)
+        self.string_params = copy.deepcopy(string_params)
+
+    def check_atoms():
+        # The iteration may only have sorted the atoms and moved them all
+        # by the same amount to center the perturbed atom
+        self.unsort_lrU()
+        shift = self.atoms.get_scaled_positions() - atoms.get_scaled_positions()
+        shift -= shift[0]
+        shift -= np.round(shift)
+        if (np.abs(shift).max() > 1e-6
+            or not np.array_equal(self.atoms.get_initial_magnetic_moments(),
+                                  atoms.get_initial_magnetic_moments())):
+            raise RuntimeError('The atoms were changed in {0}'.format(scU_dir))
+
+    keys = sorted(patoms.keys())
+    calc_name = os.path.basename(self.espressodir)
+    pert_dirs = ['{0}-{1:d}-pert'.format(calc_name, i + 1) for i in range(len(keys))]
+    U_in = [list_params['Hubbard_U'][key] for key in keys]
+
+    in_scratch = string_params['outdir'].startswith(os.path.dirname(ESPRESSORC['rundir']))
+
+    cwd = os.getcwd()
+    for k in range(maxiter):
+        scU_dir = 'scU-{0:d}'.format(k)
+        if not isdir(scU_dir):
+            os.makedirs(scU_dir)
+
+        # The Us are written once so reruns repeat the same iteration
+        U_file = os.path.join(scU_dir, 'U_in')
+        if os.path.exists(U_file):
+            U_in = [float(U) for U in open(U_file).read().split()]
         else:
-            self.run_params['jobname'] += '-pert'
+            f = open(U_file, 'w')
+            f.write(' '.join(['{0:.6f}'.format(U) for U in U_in]) + '\n')
+            f.close()
+
+        restore()
+        for U, key in zip(U_in, keys):
+            for index in patoms[key]:
+                self.list_params['Hubbard_U'][index] = U
+
+        # Start from the previous iteration if all of its files were kept.
+        # They can only be linked if pw.x works on copies in scratch.
+        if k > 0:
+            previous = [os.path.join('scU-{0:d}'.format(k - 1), d) for d in pert_dirs]
+            if all([isdir(os.path.join(d, self.filename + '.save')) for d in previous]):
+                self.string_params['startingwfc'] = 'file'
+                self.string_params['startingpot'] = 'file'
+                for d, pert_dir in zip(previous, pert_dirs):
+                    pert_dir = os.path.join(scU_dir, pert_dir)
+                    if not os.path.exists(os.path.join(pert_dir, self.filename + '.out')):
+                        link_files(d, pert_dir, WFC_FILES, link=in_scratch)
+
+        os.chdir(scU_dir)
+        try:
+            Us = self.get_linear_response_Us(patoms, center=center, alphas=alphas)
+        finally:
+            os.chdir(cwd)
+        check_atoms()
 
-        resources = '-l walltime={0},nodes={1:d}:ppn={2:d}'
-        if test == True:
-            print script
-            continue
-        p = Popen(['qsub',
-                   self.run_params['options'],
-                   '-N', self.run_params['jobname'] + '_{0}'.format(alpha),
-                   resources.format(self.run_params['walltime'],
-                                    self.run_params['nodes'],
-                                    self.run_params['ppn'])],
-                  stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        out, err = p.communicate(script)
-        f = open('jobid', 'w')
-        f.write(out)
-        f.close()
+        if Us is None:
+            restore()
+            return
+        if np.abs(np.array(Us) - np.array(U_in)).max() < tol:
+            restore()
+            return Us
+        U_in = list(Us)
 
-    return
+    restore()
+    raise EspressoNotConverged('U not self-consistent after {0:d} iterations'.format(maxiter))
+
+Espresso.get_self_consistent_Us = get_self_consistent_Us
+
+def run_pert_parallel(self, alphas=(-0.15, -0.07, 0, 0.07, 0.15), index=1, test=False):
+    '''Runs the perturbations as a job array. This is run_pert with
+    mode='array', kept for old scripts.
+    '''
+
+    return self.run_pert(alphas=alphas, index=index, test=test, mode='array')
 
 Espresso.run_pert_parallel = run_pert_parallel
 
@@ -621,45 +1098,15 @@ def calc_U(self, dict_index, alphas=(-0.15, -0.07, 0, 0.07, 0.15), test=False, s
         assert isfile('results/alpha_{0}.out'.format(alpha))
         assert self.check_calc_complete(filename='results/alpha_{0}.out'.format(alpha))
 
-    # Create the arrays for storing the atom and their occupancies
-    alpha_0s, alpha_fs = [], []
-
     # Store the initial and final occupations in arrays
-    for alpha in alphas:
-        occ_0s, occ_fs = [], []
-        outfile = open('results/alpha_{0}.out'.format(alpha))
-        lines = outfile.readlines()
-        calc_started = False
-        calc_finished = False
-        for line in lines:
-            # We first want to read the initial occupancies. This happens after
-            # the calculation starts.
-            if line.startswith('     Self'):
-                calc_started = True
-            if line.startswith('     End'):
-                calc_finished = True
-            # We will first 
-            if not line.startswith('atom '):
-                continue
-            occ = float(line.split()[-1])
-            if calc_started == True and calc_finished == False:
-                occ_0s.append(occ)
-            elif calc_finished == True:
-                occ_fs.append(occ)
-            else:
-                continue
-        alpha_0s.append(occ_0s)
-        alpha_fs.append(occ_fs)
+    atoms, alpha_0s, alpha_fs = self.get_occupations(alphas)
 
     # Write out the dn files
     dnda = open('Ucalc/dnda', 'w')
     key = dict_index.keys()[0]
     pindex = dict_index[key].index(key)
     for j, atom in enumerate(dict_index[key]):
-        list_0, list_f = [], []
-        for i, alpha in enumerate(alphas):
-            list_0.append(alpha_0s[i][atom])
-            list_f.append(alpha_fs[i][atom])
+        list_0, list_f = alpha_0s[:, atom], alpha_fs[:, atom]
         dn0_file = open('Ucalc/dn0.{0}.da.{1}.dat'.format(int(j) + 1,
                                                           pindex + 1), 'w')
         for alpha, occ in zip(alphas, list_0):
@@ -0,0 +1,195 @@
+# Copyright (C) 2013 - Zhongnan Xu
+"""This module contains functions for choosing how the processors of a
+calculation are split into k-point pools and diagonalization groups
+"""
+
+from espresso import *
+
+def get_timing_file(self):
+    '''Returns the absolute path of the file where the timings of
+    previous runs of this calculation are recorded'''
+
+    return os.path.join(self.cwd, self.espressodir, self.filename + '.timing')
+
+Espresso.get_timing_file = get_timing_file
+
+def write_layout(self, layout):
+    '''Writes the layout a run is submitted with so that its timing can
+    be recorded once the run has finished'''
+
+    f = open(self.filename + '.layout', 'w')
+    f.write('{nodes:d} {ppn:d} {npool:d} {ndiag:d}\n'.format(**layout))
+    f.close()
+
+    return
+
+Espresso.write_layout = write_layout
+
+def record_timing(self):
+    '''Appends the layout and walltime of the last finished run to the
+    timing file. Each line of the file is
+
+    nodes ppn npool ndiag nkpts nbands seconds
+
+    Nothing is written if the run did not finish, the output lacks the
+    number of k-points, bands or the walltime, or the line has already
+    been recorded.'''
+
+    if not getattr(self, 'calc_finished', False):
+        return
+    for attribute in ('wall_seconds', 'nkpts', 'nbands'):
+        if getattr(self, attribute, None) is None:
+            return
+
+    # The layout file is written when submitting. Older runs only have
+    # the total number of processors in the output.
+    if os.path.exists(self.filename + '.layout'):
+        layout = [int(d) for d in open(self.filename + '.layout').readline().split()]
+    else:
+        layout = [1, self.processors, self.npool, self.ndiag]
+
+    s = '{0:d} {1:d} {2:d} {3:d} {4:d} {5:d} {6:.2f}\n'
+    line = s.format(layout[0], layout[1], layout[2], layout[3],
+                    self.nkpts, self.nbands, self.wall_seconds)
+
+    fname = self.get_timing_file()
+    if os.path.exists(fname):
+        if line in open(fname, 'r').readlines():
+            return
+    f = open(fname, 'a')
+    f.write(line)
+    f.close()
+
+    return
+
+Espresso.record_timing = record_timing
+
+def read_timings(self):
+    '''Returns a list of (nodes, ppn, npool, ndiag, nkpts, nbands, seconds)
+    tuples of the runs recorded in the timing file'''
+
+    fname = self.get_timing_file()
+    if not os.path.exists(fname):
+        return []
+
+    timings = []
+    for line in open(fname, 'r'):
+        data = line.split()
+        if len(data) != 7:
+            continue
+        timings.append(tuple([int(d) for d in data[:6]] + [float(data[6])]))
+
+    return timings
+
+Espresso.read_timings = read_timings
+
+def get_number_of_kpoints(self):
+    '''Returns the number of irreducible k-points. This is read from
+    a previous output file when there is one. Otherwise it is estimated
+    from the k-point mesh assuming time-reversal symmetry only, which is
+    an upper bound on what pw.x will find.'''
+
+    if getattr(self, 'nkpts', None) is not None:
+        return self.nkpts
+
+    kpts = self.input_params['kpts']
+    nkpts = int(kpts[0]) * int(kpts[1]) * int(kpts[2])
+    if nkpts > 1:
+        nkpts = (nkpts + 1) / 2
+    if self.int_params['nspin'] == 2:
+        nkpts *= 2
+
+    return nkpts
+
+Espresso.get_number_of_kpoints = get_number_of_kpoints
+
+def get_parallel_layout(self, nodes=None, ppn=None, min_efficiency=0.8):
+    '''Chooses the number of k-point pools, the size of the diagonalization
+    group and the number of processors per node used for running.
+
+    The number of pools is the largest divisor of the number of processors
+    that does not leave more than (1 - min_efficiency) of the pools idle
+    while the irreducible k-points are distributed. Parallel diagonalization
+    is only used for large numbers of bands, where it pays off.
+
+    If the timing file shows that a different layout on the same number
+    of nodes ran faster than the chosen one, that layout is used instead.
+
+    Returns a dictionary with the keys 'npool', 'ndiag' and 'ppn'.'''
+
+    if nodes == None:
+        nodes = self.run_params['nodes']
+    if ppn == None:
+        ppn = self.run_params['ppn']
+
+    nkpts = self.get_number_of_kpoints()
+    if getattr(self, 'nbands', None) is not None:
+        nbands = self.nbands
+    elif self.int_params['nbnd'] is not None:
+        nbands = self.int_params['nbnd']
+    else:
+        nbands = 0
+
+    def choose(processors):
+        npool = 1
+        for n in range(1, min(processors, nkpts) + 1):
+            if processors % n != 0:
+                continue
+            kpts_per_pool = (nkpts + n - 1) / n
+            if float(nkpts) / (n * kpts_per_pool) >= min_efficiency:
+                npool = n
+        # Subspace diagonalization only benefits from ScaLAPACK when
+        # there are a lot of bands, and it needs a square grid
+        ndiag = 1
+        if nbands >= 100:
+            procs_per_pool = processors / npool
+            ndiag = int(np.sqrt(procs_per_pool)) ** 2
+        return npool, ndiag
+
+    npool, ndiag = choose(nodes * ppn)
+    layout = {'npool': npool, 'ndiag': ndiag, 'ppn': ppn}
+
+    # Now see if a previous run on the same nodes did better than this
+    timings = [t for t in self.read_timings()
+               if t[0] == nodes and t[1] <= ppn and t[4] in (0, nkpts)]
+    measured = [t for t in timings if t[1:4] == (ppn, npool, ndiag)]
+    if len(measured) > 0:
+        best = min(timings, key=lambda t: t[-1])
+        if best[-1] < min(measured, key=lambda t: t[-1])[-1]:
+            layout = {'npool': best[2], 'ndiag': best[3], 'ppn': best[1]}
+
+    return layout
+
+Espresso.get_parallel_layout = get_parallel_layout
+
+def get_pw_flags(self, nodes=None, ppn=None):
+    '''Returns the number of processors and the pw.x command line flags for
+    distributing them. With run_params['pools'] = 'auto' the layout is
+    chosen with get_parallel_layout, otherwise the pools and ndiag given
+    in run_params are used. The layout is stored in self.layout so it can
+    be written with write_layout.'''
+
+    if nodes == None:
+        nodes = self.run_params['nodes']
+    if ppn == None:
+        ppn = self.run_params['ppn']
+
+    if self.run_params['pools'] == 'auto':
+        layout = self.get_parallel_layout(nodes=nodes, ppn=ppn)
+    else:
+        layout = {'npool': self.run_params['pools'],
+                  'ndiag': self.run_params['ndiag'],
+                  'ppn': ppn}
+
+    layout['nodes'] = nodes
+    if layout['ndiag'] == None:
+        layout['ndiag'] = 1
+    self.layout = layout
+
+    # ndiag is always given, because without it pw.x chooses its own
+    # diagonalization group and the recorded layout would be wrong
+    flags = '-npool {0} -ndiag {1}'.format(layout['npool'], layout['ndiag'])
+
+    return nodes * layout['ppn'], flags
+
+Espresso.get_pw_flags = get_pw_flags
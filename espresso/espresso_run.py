@@ -4,24 +4,26 @@
 
 from espresso import *
 
-def run(self, series=False, jobid='jobid'):
-    """Submits a calculation to the queue
-
-    The settings for running the calculation are specified as kwargs
-    of the QuantumEspresso class.
-
-    For some reason when running a DFT+U calculation, it always generates
-    the wave function files. I've made it so it automatically deletes those
-    files if disk='none' is set.
-    """
-
-    in_file = self.filename + '.in'
-    out_file = self.filename + '.out'
-    run_file_name = self.filename + '.run'
-    if self.run_params['jobname'] == None:
-        self.run_params['jobname'] = self.espressodir
-
-    np = self.run_params['nodes'] * self.run_params['ppn']
+from espresso_stage import *
+
+def walltime_to_seconds(walltime):
+    '''Converts a walltime of the form [days-]hours:minutes:seconds
+    to seconds'''
+
+    days = 0
+    if '-' in walltime:
+        days, walltime = walltime.split('-')
+    seconds = 0
+    for field in walltime.split(':'):
+        seconds = seconds * 60 + int(field)
+    return int(days) * 86400 + seconds
+
+def get_script_header(self, jobname, array=None):
+    """Returns the start of a run script with the scheduler directives
+    from run_params, the flag mpicmd takes the number of processors with
+    and the command that submits the script. The script ends in the
+    directory the job was submitted from. With array set the script is
+    submitted as a job array of that many jobs, numbered from 0."""
 
     # Start the run script
     if self.run_params['qsys'] == 'pbs':
@@ -32,7 +34,7 @@ def run(self, series=False, jobid='jobid'):
 #PBS -l walltime={0}
 #PBS -j oe
 #PBS -N {1}
-'''.format(self.run_params['walltime'], self.run_params['jobname'])
+'''.format(self.run_params['walltime'], jobname)
     else:
         q='SBATCH'
         npflag='-n'
@@ -40,7 +42,7 @@ def run(self, series=False, jobid='jobid'):
         script = '''#!/bin/bash
 #SBATCH --time={0}
 #SBATCH --job-name={1}
-'''.format(self.run_params['walltime'], self.run_params['jobname'])
+'''.format(self.run_params['walltime'], jobname)
 
     # Now add pieces to the script depending on whether we need to
     # pick the processor or the memory
@@ -72,12 +74,44 @@ def run(self, series=False, jobid='jobid'):
         else:
             script += '#SBATCH -p {0}\n'.format(self.run_params['queue'])
 
+    if array != None:
+        if self.run_params['qsys'] == 'pbs':
+            script += '#PBS -t 0-{0:d}\n'.format(array - 1)
+        else:
+            script += '#SBATCH --array=0-{0:d}\n'.format(array - 1)
+
     # Now add the parts of the script for running calculations
+    script += stage_function()
     if self.run_params['qsys'] == 'pbs':
         script += '\ncd $PBS_O_WORKDIR\n'
     else:
         script += '\ncd $SLURM_SUBMIT_DIR\n'
 
+    return script, npflag, subcmd
+
+Espresso.get_script_header = get_script_header
+
+def run(self, series=False, jobid='jobid'):
+    """Submits a calculation to the queue
+
+    The settings for running the calculation are specified as kwargs
+    of the QuantumEspresso class.
+
+    For some reason when running a DFT+U calculation, it always generates
+    the wave function files. I've made it so it automatically deletes those
+    files if disk='none' is set.
+    """
+
+    in_file = self.filename + '.in'
+    out_file = self.filename + '.out'
+    run_file_name = self.filename + '.run'
+    if self.run_params['jobname'] == None:
+        self.run_params['jobname'] = self.espressodir
+
+    np = self.run_params['nodes'] * self.run_params['ppn']
+
+    script, npflag, subcmd = self.get_script_header(self.run_params['jobname'])
+
     # If disk_io is not 'none', we need to edit the input file so the wfcdir
     # variable correctly points to the local folder where the wfc are found
     if self.string_params['outdir'].startswith(os.path.dirname(ESPRESSORC['rundir'])):
@@ -86,18 +120,34 @@ def run(self, series=False, jobid='jobid'):
         else:
             script += "sed -i 's@${SLURM_JOBID}@'${SLURM_JOBID}'@' " + '{0}\n'.format(in_file)
 
+    # Restarts need the files that were moved out of the scratch directory,
+    # and so do calculations starting from the wavefunctions or charge
+    # density of a previous one
+    if self.string_params['outdir'].startswith(os.path.dirname(ESPRESSORC['rundir'])):
+        if self.string_params['restart_mode'] == 'restart':
+            script += stage_command('.', self.string_params['outdir'], RESTART_FILES)
+        elif 'file' in (self.string_params['startingwfc'], self.string_params['startingpot']):
+            script += stage_command('.', self.string_params['outdir'], WFC_FILES)
+
+    stage_pseudo, unstage_pseudo = self.stage_pseudopotentials(in_file)
+    script += stage_pseudo
+
     if np == 1:
         runscript = '{0} < {1} | tee {2}\n'
         script += runscript.format(self.run_params['executable'], in_file, out_file)
     else:
-        runscript = '{5} {6} {0:d} {1} -inp {2} -npool {3} | tee {4}\n'
+        np, flags = self.get_pw_flags()
+        self.write_layout(self.layout)
+        runscript = '{5} {6} {0:d} {1} -inp {2} {3} | tee {4}\n'
         script += runscript.format(np, self.run_params['executable'],
-                                   in_file, self.run_params['pools'], out_file, 
+                                   in_file, flags, out_file, 
                                    self.run_params['mpicmd'], npflag)
 
+    script += unstage_pseudo
+
     # We want to copy the wavefunction file back into the CWD
     if self.string_params['outdir'].startswith(os.path.dirname(ESPRESSORC['rundir'])):
-        script += '\nmv {0}/* .\n'.format(self.string_params['outdir'])
+        script += '\n' + stage_command(self.string_params['outdir'], '.', ['*'], link=True)
         script += 'rm -fr {0}\n'.format(self.string_params['outdir'])
 
     if self.string_params['disk_io'] == 'none':
@@ -126,13 +176,153 @@ def run(self, series=False, jobid='jobid'):
 
 Espresso.run = run
 
+def set_max_seconds(self):
+    '''With run_params['autorestart'] set, makes pw.x stop cleanly before the
+    walltime runs out so the calculation can be continued by continue_run.
+    A fraction run_params['walltime_buffer'] of the walltime is left for
+    writing the restart files. An explicitly given max_seconds is kept.'''
+
+    if not self.run_params['autorestart'] or self.kwargs.has_key('max_seconds'):
+        return
+
+    walltime = walltime_to_seconds(self.run_params['walltime'])
+    max_seconds = walltime * (1 - self.run_params['walltime_buffer'])
+    self.real_params['max_seconds'] = float(int(max_seconds))
+
+    return
+
+Espresso.set_max_seconds = set_max_seconds
+
+def get_number_of_restarts(self):
+    '''Returns how many times the calculation has been continued with
+    continue_run. The output of each stopped run is kept as pwscf.out.[n]'''
+
+    return len(glob.glob(self.filename + '.out.[0-9]*'))
+
+Espresso.get_number_of_restarts = get_number_of_restarts
+
+def continue_run(self):
+    '''Resubmits a calculation that pw.x stopped because max_seconds was
+    reached. The old output is moved to pwscf.out.[n]. If the restart files
+    were saved the run continues with restart_mode='restart', otherwise it
+    starts from scratch at the last geometry read from the output.'''
+
+    n = self.get_number_of_restarts() + 1
+    os.rename(self.filename + '.out', '{0}.out.{1:d}'.format(self.filename, n))
+
+    if os.path.isdir(self.filename + '.save'):
+        self.string_params['restart_mode'] = 'restart'
+    else:
+        self.string_params['restart_mode'] = 'from_scratch'
+
+    self.set_max_seconds()
+    self.write_input()
+    self.run()
+
+    return
+
+Espresso.continue_run = continue_run
+
+def run_projwfc(self, in_file, out_file, local=False, jobid='jobid-dos'):
+    """Runs projwfc.x on the finished calculation without waiting for it.
+
+    The processors and pools are chosen the same way as for pw.x, on the
+    nodes pw.x was last submitted with. By default the run is submitted to
+    the queue and the id of the job is written to jobid. With local=True
+    projwfc.x is started in the background on this machine instead and its
+    process id is written to pid-dos. Use projwfc_running to see whether
+    the run is still going."""
+
+    # Use the nodes the calculation itself was run on
+    if os.path.exists(self.filename + '.layout'):
+        layout = [int(d) for d in open(self.filename + '.layout').readline().split()]
+        self.run_params['nodes'], self.run_params['ppn'] = layout[0], layout[1]
+
+    executable = ESPRESSORC.get('projwfc', 'projwfc.x')
+    np, flags = self.get_pw_flags()
+
+    if self.run_params['jobname'] == None:
+        jobname = self.espressodir + '-dos'
+    else:
+        jobname = self.run_params['jobname'] + '-dos'
+    script, npflag, subcmd = self.get_script_header(jobname)
+
+    if local == True:
+        if np == 1:
+            command = [executable]
+        else:
+            command = ([self.run_params['mpicmd'], npflag, str(np), executable]
+                       + flags.split())
+        out = open(out_file, 'w')
+        p = Popen(command, stdin=open(in_file, 'r'), stdout=out, stderr=out)
+        f = open('pid-dos', 'w')
+        f.write('{0:d}\n'.format(p.pid))
+        f.close()
+        return
+
+    if np == 1:
+        script += '{0} < {1} > {2}\n'.format(executable, in_file, out_file)
+    else:
+        runscript = '{0} {1} {2:d} {3} -inp {4} {5} > {6}\n'
+        script += runscript.format(self.run_params['mpicmd'], npflag, np,
+                                   executable, in_file, flags, out_file)
+    script += '# end'
+
+    run_file_name = self.filename + '.dos.run'
+    run_file = open(run_file_name, 'w')
+    run_file.write(script)
+    run_file.close()
+
+    p = Popen([subcmd, run_file_name], stdout=PIPE, stderr=PIPE)
+    out, err = p.communicate()
+
+    if out == '' or err !='':
+        raise Exception('something went wrong in {1}:\n\n{0}'.format(err, subcmd))
+
+    f = open(jobid, 'w')
+    f.write(out)
+    f.close()
+
+    return
+
+Espresso.run_projwfc = run_projwfc
+
+def projwfc_running(self, jobid='jobid-dos'):
+    """Returns True if a projwfc.x run started by run_projwfc is queued or
+    still running. The jobid and pid-dos files of finished runs are removed."""
+
+    if os.path.exists(jobid):
+        if self.job_in_queue(jobid):
+            return True
+        os.unlink(jobid)
+
+    if os.path.exists('pid-dos'):
+        pid = int(open('pid-dos').readline())
+        try:
+            # Runs started from this process have to be reaped, others
+            # are checked by sending them signal 0
+            if os.waitpid(pid, os.WNOHANG) == (0, 0):
+                return True
+        except OSError:
+            try:
+                os.kill(pid, 0)
+                return True
+            except OSError:
+                pass
+        os.unlink('pid-dos')
+
+    return False
+
+Espresso.projwfc_running = projwfc_running
+
 def run_series(name, calcs, walltime='50:00:00', ppn=1, nodes=1, processor=None, mem=None,
                pools=1, save=True, test=False, update_pos=False, qsys='pbs', queue=None):
     '''The point of this function is to create a script that runs a bunch of
     calculations in series. After a calculation is done, it'll move the necessary
     restart output from the first calculation to the next. It takes a list of espresso
     calculators. 'save' tells the program whether to save or delete the wavefunction files
-    after each calculation.
+    after each calculation. With pools='auto' the pools of every calculation are chosen
+    with Espresso.get_parallel_layout.
     '''
 
     dirs, names, executables, convergences = [], [], [], []
@@ -234,14 +424,17 @@ def run_series(name, calcs, walltime='50:00:00', ppn=1, nodes=1, processor=None,
         else:
             script += '#SBATCH --mem-per-cpu={0}\n'.format(1024*int(mem.lower().split('gb')[0]))
 
-    script += '\n' # I just add this so there's a space after the #PBS commands
-
     if queue != None:
         if qsys == 'pbs':
             script += '#PBS -q {0}\n'.format(queue)
         else:
             script += '#SBATCH -p {0}\n'.format(queue)
 
+    # The stage function has to come after all of the directives, because
+    # the queue systems stop reading them at the first command
+    script += '\n' # I just add this so there's a space after the #PBS commands
+    script += stage_function()
+
 
     # Now add on the parts of the script needed for the restarts.
     if update_pos == True:
@@ -249,19 +442,18 @@ def run_series(name, calcs, walltime='50:00:00', ppn=1, nodes=1, processor=None,
     else:
         update_atoms = ''
 
-    np = nodes * ppn
+    def pw_flags(calc):
+        '''Returns the number of processors and the pw.x flags of a
+        calculation. The layout may use fewer processors per node than
+        ppn, so the number of processors has to come from it as well.'''
+        calc.run_params['pools'] = pools
+        return calc.get_pw_flags(nodes=nodes, ppn=ppn)
 
     # The beginning of the code will be different depending on whether we need a restart
     calc = calcs[0] # We need this for some variables
     if len(done_dirs) != 0:
         # Copy the previous converged WFC files into /scratch/${PBS_JOBID} directory
-        script += 'cd {0}\n'.format(done_dirs[-1])
-        
-        # Since we haven't run a script yet, we need to make the directory
-        script += 'mkdir {0}\n'.format(calc.string_params['outdir'])
-
-        script += 'cp -r pwscf.atwfc* pwscf.satwfc1* pwscf.wfc* pwscf.occup pwscf.igk* pwscf.save '
-        script += '{0}\n'.format(calc.string_params['outdir'])
+        script += stage_command(done_dirs[-1], calc.string_params['outdir'], WFC_FILES)
 
     # Change into directory and edit input file to reflect correct /scratch dir
     script += 'cd {0}\n'.format(dirs[0])
@@ -276,14 +468,16 @@ def run_series(name, calcs, walltime='50:00:00', ppn=1, nodes=1, processor=None,
     if (ppn == 1 and nodes == 1):
         script += '{0} < {1}.in | tee {1}.out\n\n'.format(executables[0], names[0])
     else:
-        s = '{0} {5} {1} {2} -inp {3}.in -npool {4} | tee {3}.out \n\n'
-        script += s.format(calc.run_params['mpicmd'], np, executables[0], names[0], pools, npflag)
+        np, flags = pw_flags(calc)
+        s = '{0} {5} {1} {2} -inp {3}.in {4} | tee {3}.out \n\n'
+        script += s.format(calc.run_params['mpicmd'], np, executables[0], names[0],
+                           flags, npflag)
 
-    # Copy completed job wavefunction from /scratch/${PBS_JOBID} back into working directory
+    # Copy completed job wavefunction from /scratch/${PBS_JOBID} back into working
+    # directory. The next calculation overwrites these files, so they are not linked
     if save == True:
-        script += 'cd {0}\n'.format(calc.string_params['outdir'])
-        s = 'cp -r pwscf.atwfc* pwscf.satwfc1* pwscf.wfc* pwscf.occup pwscf.igk* pwscf.save {0}\n'
-        script += s.format(dirs[0])
+        script += stage_command(calc.string_params['outdir'], dirs[0], WFC_FILES,
+                                link=(len(dirs) == 1))
             
     # Now do the rest of the calculations
     for calc, d, n, r in zip(calcs[1:], dirs[1:], names[1:], executables[1:]):
@@ -299,14 +493,14 @@ def run_series(name, calcs, walltime='50:00:00', ppn=1, nodes=1, processor=None,
         if (ppn == 1 and nodes == 1):
             script += '{0} < {1}.in | tee {1}.out\n\n'.format(r, n)
         else:
-            s = '{0} {5} {1} {2} -inp {3}.in -npool {4} | tee {3}.out\n\n'
-            script += s.format(calc.run_params['mpicmd'], np, r, n, pools, npflag)
+            np, flags = pw_flags(calc)
+            s = '{0} {5} {1} {2} -inp {3}.in {4} | tee {3}.out\n\n'
+            script += s.format(calc.run_params['mpicmd'], np, r, n, flags, npflag)
 
         # Copy the wavefunction files back into home directory
         if (save == True or calc.bool_params['wf_collect'] == True):
-            script += 'cd {0}\n'.format(calc.string_params['outdir'])
-            s = 'cp -r pwscf.atwfc* pwscf.satwfc1* pwscf.wfc* pwscf.occup pwscf.igk* pwscf.save {0}\n'
-            script += s.format(d)
+            script += stage_command(calc.string_params['outdir'], d, WFC_FILES,
+                                    link=(d == dirs[-1]))
         
     script += 'rm -fr {0}\n'.format(calc.string_params['outdir'])
 
@@ -0,0 +1,149 @@
+# Copyright (C) 2013 - Zhongnan Xu
+"""This module contains the pieces of the run scripts that move restart
+data and pseudopotentials between the working directories and scratch
+"""
+
+from espresso import *
+
+# These are the files needed to start a calculation from the wavefunctions
+# of a previous one
+WFC_FILES = ['pwscf.atwfc*', 'pwscf.satwfc1*', 'pwscf.wfc*', 'pwscf.occup',
+             'pwscf.igk*', 'pwscf.save']
+
+# These are the files pw.x writes into outdir that are needed to restart
+RESTART_FILES = ['pwscf.save', 'pwscf.wfc*', 'pwscf.igk*', 'pwscf.atwfc*',
+                 'pwscf.satwfc*', 'pwscf.occup', 'pwscf.bfgs', 'pwscf.restart*',
+                 'pwscf.mix*', 'pwscf.md', 'pwscf.update']
+
+# These are the files of a save directory that pw.x only reads when it
+# starts from it with wf_collect = .false., so they can be shared
+SHARED_FILES = ['evc*', 'wfc*']
+
+# The stage function is written at the top of every run script. Patterns
+# are expanded inside the source directory. Files are hardlinked when
+# linking is allowed and both directories are on the same filesystem,
+# otherwise they are copied in parallel. rsync skips files whose size and
+# modification time have not changed. Copies never write into existing
+# files, which may be hardlinks to other calculations: rsync writes new
+# files and renames them, cp removes the old ones first. The time spent is
+# printed to the job output. unshare and snapshot are used by
+# unshare_command and snapshot_command.
+STAGE_FUNCTION = '''
+stage () {
+    local mode=$1 src=$2 dst=$3 start=$(date +%s.%N) cmd
+    shift 3
+    mkdir -p "$dst"
+    dst=$(cd "$dst" && pwd)
+    if [ $mode = link ] && [ $(stat -c %d "$src") = $(stat -c %d "$dst") ]; then
+        cmd='cp -al --remove-destination'
+    elif command -v rsync > /dev/null; then
+        cmd='rsync -a'
+    else
+        cmd='cp -au --remove-destination'
+    fi
+    (cd "$src" && ls -d $@ 2> /dev/null | xargs -r -P ${STAGE_NPROC:-@NPROC@} -I{} $cmd {} "$dst"/)
+    echo "stage: $src -> $dst ($cmd) $(awk "BEGIN {print $(date +%s.%N) - $start}") s"
+}
+
+unshare () {
+    local dst=$1
+    shift
+    find "$dst" -type f -links +1 "$@" -exec sh -c 'cp -p "$0" "$0.tmp" && mv -f "$0.tmp" "$0"' {} \;
+}
+
+snapshot () {
+    (cd "$1" && find . -type f -printf '%s %T@ %p\\n' | sort | md5sum)
+}
+'''
+
+def stage_function():
+    '''Returns the definition of the stage shell function used by
+    stage_command. The number of parallel copies is ESPRESSORC['stage_nproc'].'''
+
+    return STAGE_FUNCTION.replace('@NPROC@', str(ESPRESSORC.get('stage_nproc', 8)))
+
+def stage_command(src, dst, patterns, link=False):
+    '''Returns the line of a run script that stages the files in src
+    matching patterns into dst.
+
+    Only use link=True when the files in src will not be written to again
+    while the copies in dst are needed, because pw.x overwrites its files
+    in place and hardlinked copies would change with them.'''
+
+    if link == True:
+        mode = 'link'
+    else:
+        mode = 'copy'
+    patterns = ' '.join(["'{0}'".format(p) for p in patterns])
+
+    return 'stage {0} {1} {2} {3}\n'.format(mode, src, dst, patterns)
+
+def unshare_command(dst, shared=SHARED_FILES):
+    '''Returns the line of a run script that replaces the hardlinked files
+    in dst by copies of their own, except for the ones matching shared.
+    Use it after staging with link=True into a directory pw.x will write
+    to, so that only the files it never writes stay shared.'''
+
+    names = ' '.join(["! -name '{0}'".format(p) for p in shared])
+    return 'unshare {0} {1}\n'.format(dst, names)
+
+def snapshot_command(src, name):
+    '''Returns the line of a run script that stores a checksum of the
+    sizes and modification times of the files in src in the shell
+    variable name, and the line that stops the script if they have
+    changed since then'''
+
+    before = '{0}=$(snapshot {1})\n'.format(name, src)
+    after = ('[ "$(snapshot {1})" = "${0}" ] || '
+             '{{ echo "{1} was modified while it was shared" >&2; exit 1; }}\n')
+    return before, after.format(name, src)
+
+def link_files(src, dst, patterns, link=True):
+    '''Hardlinks the files in src matching patterns into dst, the way
+    stage_command does in run scripts. Directories are linked file by
+    file. Files are copied if link=False or they are on different
+    filesystems, and files that are already in dst are kept. The same
+    caveat as for stage_command applies to linking.'''
+
+    for pattern in patterns:
+        for path in glob.glob(os.path.join(src, pattern)):
+            if os.path.isdir(path):
+                link_files(path, os.path.join(dst, os.path.basename(path)), ['*'], link)
+                continue
+            if not os.path.isdir(dst):
+                os.makedirs(dst)
+            target = os.path.join(dst, os.path.basename(path))
+            if os.path.exists(target):
+                continue
+            try:
+                if link == True:
+                    os.link(path, target)
+                    continue
+            except OSError:
+                pass
+            shutil.copy2(path, target)
+
+    return
+
+def stage_pseudopotentials(self, in_file):
+    '''Returns the lines of a run script that copy the pseudopotentials to
+    the node-local directory run_params['pseudo_stage'] and point the input
+    file at them, and the lines that point the input file back afterwards.
+    The pseudopotentials are staged on the node that runs the script, so
+    for runs over several nodes pseudo_stage should be a shared directory.'''
+
+    if self.run_params['pseudo_stage'] == None:
+        return '', ''
+
+    pseudo_dir = self.string_params['pseudo_dir']
+    pseudo_stage = self.run_params['pseudo_stage']
+    PPs = sorted(set([species[2] for species in self.atomic_species]))
+
+    sed = '''sed -i "s@pseudo_dir = '{0}'@pseudo_dir = '{1}'@" {2}\n'''
+    before = stage_command(pseudo_dir, pseudo_stage, PPs, link=True)
+    before += sed.format(pseudo_dir, pseudo_stage, in_file)
+    after = sed.format(pseudo_stage, pseudo_dir, in_file)
+
+    return before, after
+
+Espresso.stage_pseudopotentials = stage_pseudopotentials
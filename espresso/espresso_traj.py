@@ -1,49 +1,450 @@
 # Copyright (C) 2013 - Zhongnan Xu
 """This module contains the files necessary for constructing trajectory files.
+Frames are read from the output one at a time and written straight to an
+ASE trajectory, an extended xyz file or a binary trajectory, so outputs
+of running relaxations can be exported again and again by only appending
+the new frames. Binary trajectories are memory mapped for random access
+to the frames of long runs.
 """
 
-import pickle
-from ase import io
+import json
+import hashlib
+from ase.calculators.singlepoint import SinglePointCalculator
+try:
+    from ase.io.trajectory import Trajectory
+except ImportError:
+    from ase.io.trajectory import PickleTrajectory as Trajectory
 
 from espresso import *
 
+BOHR = 0.529177249
+RY = 13.605698066
+
+# The binary trajectory files start with BINARY_MAGIC, the length of the
+# header and the header in JSON, padded to BINARY_ALIGN bytes. The frames
+# follow as fixed size records, so frame k starts at
+# header_size + k * record_size.
+BINARY_MAGIC = 'ESPTRAJ1'
+BINARY_ALIGN = 64
+BINARY_CHUNK = 256
+
+# Outputs are recognized by their inode and a hash of their first
+# OUTPUT_HEAD bytes, so a new output of a restarted calculation is not
+# taken for the old one that has grown
+OUTPUT_HEAD = 4096
+
+def read_frames(fname, symbols, state):
+    '''Reads the frames of a pw.x output file one at a time. Every frame is
+    a dictionary with the keys cell, scaled_positions, energy and forces,
+    in Angstrom and eV, and is made when the forces of an ionic step have
+    been printed. Calculations without forces give one frame with forces
+    None when they finish.
+
+    state is a dictionary with the keys offset, nframes, cell,
+    scaled_positions and alat. Reading starts at the byte offset with the
+    structure in state, and state is updated with every frame so reading
+    can be picked up after it later. Frames that are not completely
+    written yet are left for then.'''
+
+    natoms = len(symbols)
+    cell = np.array(state['cell'])
+    scaled_positions = np.array(state['scaled_positions'])
+    alat = state['alat']
+    energy = None
+
+    f = open(fname, 'r')
+    f.seek(state['offset'])
+
+    def read_block(n):
+        block = [f.readline() for i in range(n)]
+        if not all([line.endswith('\n') for line in block]):
+            return None
+        return block
+
+    while True:
+        line = f.readline()
+        if not line.endswith('\n'):
+            break
+        lower = line.lower()
+
+        frame = None
+        if lower.startswith('     lattice parameter (alat)'):
+            alat = float(line.split()[-2]) * BOHR
+        elif lower.startswith('!    total energy'):
+            energy = float(line.split()[-2]) * RY
+        elif lower.startswith('cell_parameters'):
+            block = read_block(3)
+            if block is None:
+                break
+            new_cell = np.array([[float(x) for x in l.split()[:3]] for l in block])
+            if 'angstrom' in lower:
+                cell = new_cell
+            elif 'bohr' in lower:
+                cell = new_cell * BOHR
+            else:
+                if 'alat' in lower:
+                    alat = float(re.findall('[0-9.]+', line.split('=')[-1])[0]) * BOHR
+                cell = new_cell * alat
+        elif lower.startswith('atomic_positions'):
+            block = read_block(natoms)
+            if block is None:
+                break
+            positions = np.array([[float(x) for x in l.split()[1:4]] for l in block])
+            if 'angstrom' in lower:
+                scaled_positions = np.linalg.solve(cell.T, positions.T).T
+            elif 'bohr' in lower:
+                scaled_positions = np.linalg.solve(cell.T, positions.T * BOHR).T
+            elif 'alat' in lower:
+                scaled_positions = np.linalg.solve(cell.T, positions.T * alat).T
+            else:
+                scaled_positions = positions
+        elif lower.startswith('     forces acting'):
+            forces = []
+            while True:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    break
+                if line.lower().startswith('     total force'):
+                    break
+                if 'force =' in line and len(forces) < natoms:
+                    forces.append([float(x) * RY / BOHR for x in line.split()[-3:]])
+            if not line.endswith('\n'):
+                break
+            frame = {'forces': np.array(forces)}
+        elif lower.startswith('   job done') and energy is not None:
+            frame = {'forces': None}
+
+        if frame is not None and energy is not None:
+            frame.update({'cell': cell.copy(),
+                          'scaled_positions': scaled_positions.copy(),
+                          'energy': energy})
+            energy = None
+            state.update({'offset': f.tell(),
+                          'nframes': state['nframes'] + 1,
+                          'cell': cell.tolist(),
+                          'scaled_positions': scaled_positions.tolist(),
+                          'alat': alat})
+            yield frame
+
+    f.close()
+
+def frame_to_atoms(symbols, frame):
+    '''Returns an atoms object of a frame, with its energy and forces
+    attached with a SinglePointCalculator'''
+
+    atoms = Atoms(symbols, cell=frame['cell'], pbc=True)
+    atoms.set_scaled_positions(frame['scaled_positions'])
+    calc = SinglePointCalculator(atoms=atoms, energy=frame['energy'],
+                                 forces=frame['forces'])
+    atoms.set_calculator(calc)
+
+    return atoms
+
+def write_extxyz_frame(f, symbols, frame):
+    '''Writes a frame to an open extended xyz file'''
+
+    cell = ' '.join(['{0:.8f}'.format(x) for x in np.array(frame['cell']).flatten()])
+    properties = 'species:S:1:pos:R:3'
+    if frame['forces'] is not None:
+        properties += ':forces:R:3'
+    f.write('{0:d}\n'.format(len(symbols)))
+    f.write('Lattice="{0}" Properties={1} energy={2:.8f} pbc="T T T"\n'.format(
+        cell, properties, frame['energy']))
+
+    positions = np.dot(frame['scaled_positions'], frame['cell'])
+    for i, symbol in enumerate(symbols):
+        values = list(positions[i])
+        if frame['forces'] is not None:
+            values += list(frame['forces'][i])
+        f.write('{0:<3s}'.format(symbol)
+                + ''.join([' {0:16.8f}'.format(x) for x in values]) + '\n')
+
+    return
+
+def get_record_dtype(natoms, dtype=np.float64):
+    '''Returns the numpy dtype of a frame of a binary trajectory. The
+    energy is always kept in double precision.'''
+
+    return np.dtype([('energy', np.float64),
+                     ('cell', dtype, (3, 3)),
+                     ('positions', dtype, (natoms, 3)),
+                     ('forces', dtype, (natoms, 3))])
+
+def read_binary_header(fname):
+    '''Returns the header of a binary trajectory and its size in bytes'''
+
+    f = open(fname, 'rb')
+    if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        f.close()
+        raise IOError('{0} is not a binary trajectory'.format(fname))
+    length = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+    header = json.loads(f.read(length))
+    f.close()
+
+    return header, len(BINARY_MAGIC) + 4 + length
+
+def write_binary_trajectory(fname, symbols, frames, dtype=np.float64, mode='w'):
+    '''Writes frames, an iterable of the dictionaries made by read_frames or
+    calc_frames, to a binary trajectory. Missing forces are stored as NaN.
+
+    With mode='a' the frames are appended to an existing file, which must
+    have the same atoms. They are written in the precision of that file.
+
+    The frames are written in chunks of BINARY_CHUNK, so only those are
+    kept in memory. Returns the number of frames written.'''
+
+    natoms = len(symbols)
+    if mode == 'a' and os.path.exists(fname):
+        header, header_size = read_binary_header(fname)
+        if header['symbols'] != list(symbols):
+            raise ValueError('The atoms of {0} do not match'.format(fname))
+        record = get_record_dtype(natoms, header['dtype'])
+        # Leave out a frame that was only partly written
+        nframes = (os.path.getsize(fname) - header_size) / record.itemsize
+        f = open(fname, 'r+b')
+        f.truncate(header_size + nframes * record.itemsize)
+        f.seek(0, 2)
+    else:
+        record = get_record_dtype(natoms, dtype)
+        header = json.dumps({'symbols': list(symbols),
+                             'dtype': np.dtype(dtype).name})
+        header += ' ' * (-(len(BINARY_MAGIC) + 4 + len(header)) % BINARY_ALIGN)
+        f = open(fname, 'wb')
+        f.write(BINARY_MAGIC)
+        np.array([len(header)], dtype=np.uint32).tofile(f)
+        f.write(header)
+
+    chunk = np.zeros(BINARY_CHUNK, dtype=record)
+    n, nwritten = 0, 0
+    for frame in frames:
+        chunk[n]['energy'] = frame['energy']
+        chunk[n]['cell'] = frame['cell']
+        chunk[n]['positions'] = np.dot(frame['scaled_positions'], frame['cell'])
+        if frame['forces'] is None:
+            chunk[n]['forces'] = np.nan
+        else:
+            chunk[n]['forces'] = frame['forces']
+        n += 1
+        if n == BINARY_CHUNK:
+            chunk.tofile(f)
+            nwritten += n
+            n = 0
+    chunk[:n].tofile(f)
+    nwritten += n
+    f.close()
+
+    return nwritten
+
+def calc_frames(calc):
+    '''Yields the frames of a calculator that has read its output, in the
+    form read_frames makes them. Only steps that have both an energy and
+    a structure are included.'''
+
+    cells = calc.all_cells
+    if len(cells) != len(calc.all_pos):
+        cells = cells * len(calc.all_pos)
+    nframes = min(len(calc.all_energies), len(calc.all_pos))
+    for i in range(nframes):
+        cell = np.array(cells[i])
+        if i < len(calc.all_forces):
+            forces = np.array(calc.all_forces[i])
+        else:
+            forces = None
+        yield {'energy': calc.all_energies[i],
+               'cell': cell,
+               'scaled_positions': np.linalg.solve(cell.T, np.array(calc.all_pos[i]).T).T,
+               'forces': forces}
+
+class BinaryTrajectory(object):
+    """Class for reading binary trajectories written by
+    write_binary_trajectory or export_trajectory. The frames are memory
+    mapped, so reading frame k or a slice of frames only reads those.
+
+    traj = BinaryTrajectory('out.etraj')
+    traj.energies[-10:]     # the last ten energies
+    traj.forces[::100]      # every hundredth set of forces
+    atoms = traj[k]         # frame k as an atoms object
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        header, self.header_size = read_binary_header(fname)
+        self.symbols = header['symbols']
+        self.natoms = len(self.symbols)
+        self.dtype = np.dtype(header['dtype'])
+        self.record = get_record_dtype(self.natoms, self.dtype)
+        self.update()
+
+    def update(self):
+        '''Maps the frames again, to see the ones appended since'''
+
+        nframes = (os.path.getsize(self.fname) - self.header_size) / self.record.itemsize
+        if nframes == 0:
+            self.frames = np.zeros(0, dtype=self.record)
+        else:
+            self.frames = np.memmap(self.fname, dtype=self.record, mode='r',
+                                    offset=self.header_size, shape=(nframes,))
+
+        return
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self.get_atoms(i) for i in range(*k.indices(len(self)))]
+        return self.get_atoms(k)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get_atoms(i)
+
+    @property
+    def energies(self):
+        return self.frames['energy']
+
+    @property
+    def cells(self):
+        return self.frames['cell']
+
+    @property
+    def positions(self):
+        return self.frames['positions']
+
+    @property
+    def forces(self):
+        return self.frames['forces']
+
+    def get_atoms(self, k):
+        '''Returns frame k as an atoms object with its energy and forces
+        attached with a SinglePointCalculator'''
+
+        frame = self.frames[k]
+        atoms = Atoms(self.symbols, positions=np.array(frame['positions'], dtype=float),
+                      cell=np.array(frame['cell'], dtype=float), pbc=True)
+        forces = np.array(frame['forces'], dtype=float)
+        if np.isnan(forces).any():
+            forces = None
+        calc = SinglePointCalculator(atoms=atoms, energy=float(frame['energy']),
+                                     forces=forces)
+        atoms.set_calculator(calc)
+
+        return atoms
+
+def get_output_fingerprint(fname, nbytes=OUTPUT_HEAD):
+    '''Returns the inode of a file, the number of bytes at its start that
+    were hashed and their md5 hash'''
+
+    f = open(fname, 'rb')
+    head = f.read(nbytes)
+    f.close()
+
+    return [os.stat(fname).st_ino, len(head), hashlib.md5(head).hexdigest()]
+
+def export_trajectory(outfile='pwscf.out', trajectory='out.traj', infile=None,
+                      follow=False, fmt=None, dtype=np.float64):
+    '''Writes the frames of a pw.x output file to an ASE trajectory, to an
+    extended xyz file if fmt is 'extxyz' or trajectory ends in .xyz or
+    .extxyz, or to a binary trajectory in dtype precision, see
+    BinaryTrajectory, if fmt is 'binary' or trajectory ends in .etraj.
+    The structure before the first step is read from infile, which
+    defaults to the input file next to outfile.
+
+    Where the export got to is kept in [trajectory].state. With
+    follow=True only the frames written since the last export are
+    appended, otherwise the trajectory is written from the start. The
+    trajectory is written from the start as well if the output file is
+    not the one that was exported, for example because the calculation
+    was restarted, or if the trajectory does not have the size the state
+    file recorded, for example because an export stopped before the
+    state file was written.
+
+    Returns the number of frames written.'''
+
+    # espresso_dos imports espresso, which imports this module, so the
+    # reader can only be imported once everything is loaded
+    from espresso_dos import read_dos_metadata
+
+    if infile == None:
+        infile = os.path.splitext(outfile)[0] + '.in'
+    if fmt == None:
+        if os.path.splitext(trajectory)[1] in ('.xyz', '.extxyz'):
+            fmt = 'extxyz'
+        elif os.path.splitext(trajectory)[1] == '.etraj':
+            fmt = 'binary'
+        else:
+            fmt = 'traj'
+    if fmt not in ('traj', 'extxyz', 'binary'):
+        raise ValueError('fmt can only be traj, extxyz or binary')
+
+    metadata = read_dos_metadata(infile)
+    symbols = metadata['symbols']
+    state_file = trajectory + '.state'
+    size = os.path.getsize(outfile)
+
+    state = None
+    if follow == True and os.path.exists(state_file) and os.path.exists(trajectory):
+        state = json.load(open(state_file, 'r'))
+        fingerprint = state.get('fingerprint')
+        if (state['outfile'] != os.path.abspath(outfile)
+            or state['offset'] > size
+            or fingerprint is None
+            or fingerprint != get_output_fingerprint(outfile, fingerprint[1])
+            or state.get('size') != os.path.getsize(trajectory)):
+            state = None
+    if state == None:
+        state = {'outfile': os.path.abspath(outfile),
+                 'offset': 0,
+                 'nframes': 0,
+                 'cell': metadata['cell'].tolist(),
+                 'scaled_positions': metadata['scaled_positions'].tolist(),
+                 'alat': None}
+        mode = 'w'
+    else:
+        mode = 'a'
+
+    nframes = state['nframes']
+    if fmt == 'traj':
+        out = Trajectory(trajectory, mode)
+        for frame in read_frames(outfile, symbols, state):
+            out.write(frame_to_atoms(symbols, frame))
+        out.close()
+    elif fmt == 'extxyz':
+        out = open(trajectory, mode)
+        for frame in read_frames(outfile, symbols, state):
+            write_extxyz_frame(out, symbols, frame)
+        out.close()
+    else:
+        write_binary_trajectory(trajectory, symbols, read_frames(outfile, symbols, state),
+                                dtype=dtype, mode=mode)
+
+    state['fingerprint'] = get_output_fingerprint(outfile)
+    state['size'] = os.path.getsize(trajectory)
+    f = open(state_file + '.tmp', 'w')
+    json.dump(state, f)
+    f.close()
+    os.rename(state_file + '.tmp', state_file)
+
+    return state['nframes'] - nframes
+
 class espressotraj:
     '''This trajectory class is modeled off of the vasptraj file. To use it, use these lines of code
     traj = espressotraj()
     traj.convert()
     os.system('ag out.traj; rm out.traj')
+
+    It is a wrapper around export_trajectory for the calculation in the
+    current directory. convert(follow=True) only appends new frames.
     '''
-    def __init__(self, trajectory=None):
-        with Espresso(None) as calc:
-            self.atoms = calc.initial_atoms.copy()
-        self.calc = calc
+    def __init__(self, trajectory=None, filename='pwscf'):
         if not trajectory:
             self.trajectory = 'out.traj'
         else:
             self.trajectory = trajectory
-        self.out = io.trajectory.PickleTrajectory(self.trajectory, mode='w')
-        self.energies = calc.all_energies
-        self.forces = calc.all_forces
-        self.all_pos = calc.all_pos
-        if len(calc.all_cells) != len(calc.all_pos):
-            # Remember that these arrays are list objeects, not numpy.arrays
-            self.all_cells = calc.all_cells * len(calc.all_pos)
-        else:
-            self.all_cells = calc.all_cells
-        if len(self.energies) > len(self.all_pos):
-            self.energies.pop()
-            self.forces.pop()
-
-    def convert(self):
-        for i, energy in enumerate(self.energies):
-            if i == 0:
-                self.out.write_header(self.atoms)
-            d = {'positions': self.all_pos[i],
-                 'cell': self.all_cells[i],
-                 'momenta': None,
-                 'energy': self.energies[i],
-                 'forces': self.forces[i],
-                 'stress': None}
-            pickle.dump(d, self.out.fd, protocol=-1)
-
-        self.out.fd.close()
+        self.filename = filename
+
+    def convert(self, follow=False):
+        return export_trajectory(outfile=self.filename + '.out',
+                                 trajectory=self.trajectory,
+                                 infile=self.filename + '.in',
+                                 follow=follow)
@@ -0,0 +1,127 @@
+# Copyright (C) 2013 - Zhongnan Xu
+"""This module contains functions for reading the headers of UPF
+pseudopotential files. What is read is kept in an index on disk, so
+every file is only parsed once.
+"""
+
+import cPickle as pickle
+import hashlib
+
+from espresso import *
+
+# The index maps the path of a pseudopotential to its size, modification
+# time and header information. It is read from disk the first time it
+# is needed.
+UPF_INDEX = None
+
+def get_upf_index_file():
+    '''Returns the file the index is kept in, ESPRESSORC['pseudo_index']'''
+
+    return os.path.expanduser(ESPRESSORC.get('pseudo_index', '~/.espresso_upf_index'))
+
+def read_upf(fname):
+    '''Parses the header of a UPF file, version 1 or 2. Returns a
+    dictionary with the keys
+
+    element: the chemical symbol
+    valence: the number of valence electrons
+    wavefunctions: the lower case labels of the wavefunctions, e.g. 3d
+    wfc_cutoff, rho_cutoff: the suggested cutoffs in Ry, or 0 if not given
+    md5: the md5 hash of the file'''
+
+    text = open(fname, 'r').read()
+    info = {'md5': hashlib.md5(text).hexdigest(),
+            'wfc_cutoff': 0.,
+            'rho_cutoff': 0.}
+
+    header = re.search('<PP_HEADER(.*?)(/>|</PP_HEADER>)', text, re.S).group(1)
+    if 'z_valence' in header.lower():
+        # Version 2 keeps the header in attributes and the labels in PP_CHI tags
+        def attribute(name):
+            return re.search(name + '\s*=\s*"([^"]*)"', header, re.I).group(1).strip()
+        info['element'] = attribute('element')
+        info['valence'] = float(attribute('z_valence'))
+        for key in ('wfc_cutoff', 'rho_cutoff'):
+            try:
+                info[key] = float(attribute(key))
+            except AttributeError:
+                pass
+        info['wavefunctions'] = [label.lower() for label in
+                                 re.findall('<PP_CHI\.[0-9]+[^>]*label\s*=\s*"([^"]*)"', text)]
+    else:
+        lines = header.split('\n')[1:]
+        info['element'] = lines[1].split()[0]
+        info['wavefunctions'] = []
+        for i, line in enumerate(lines):
+            if 'z valence' in line.lower():
+                info['valence'] = float(line.split()[0])
+            elif 'suggested cutoff' in line.lower():
+                info['wfc_cutoff'] = float(line.split()[0])
+                info['rho_cutoff'] = float(line.split()[1])
+            elif line.lower().startswith(' wavefunctions'):
+                for wfc_line in lines[i + 1:]:
+                    if len(wfc_line.split()) > 0:
+                        info['wavefunctions'].append(wfc_line.split()[0].lower())
+                break
+
+    return info
+
+def get_upf_info(fname):
+    '''Returns the header information of read_upf() for a pseudopotential.
+    The file is only parsed if it is not in the index or has changed since
+    it was indexed, in which case the index on disk is updated.'''
+
+    global UPF_INDEX
+
+    index_file = get_upf_index_file()
+    if UPF_INDEX is None:
+        UPF_INDEX = {}
+        if os.path.exists(index_file):
+            try:
+                UPF_INDEX = pickle.load(open(index_file, 'rb'))
+            except Exception:
+                pass
+
+    fname = os.path.abspath(os.path.expanduser(fname))
+    stat = os.stat(fname)
+    if UPF_INDEX.has_key(fname):
+        size, mtime, info = UPF_INDEX[fname]
+        if size == stat.st_size and mtime == stat.st_mtime:
+            return info
+
+    info = read_upf(fname)
+    UPF_INDEX[fname] = (stat.st_size, stat.st_mtime, info)
+
+    # Write to a temporary file first so other processes never read half
+    # of the index
+    try:
+        tmp_file = '{0}.{1:d}'.format(index_file, os.getpid())
+        f = open(tmp_file, 'wb')
+        pickle.dump(UPF_INDEX, f, protocol=-1)
+        f.close()
+        os.rename(tmp_file, index_file)
+    except (IOError, OSError):
+        pass
+
+    return info
+
+def get_pseudo_info(self, symbol):
+    '''Returns the header information of the pseudopotential of an element,
+    found in pseudo_dir under the name given in ESPRESSO_PPs'''
+
+    fname = os.path.join(self.string_params['pseudo_dir'], self.PPs[symbol][0])
+    return get_upf_info(fname)
+
+Espresso.get_pseudo_info = get_pseudo_info
+
+def get_valence(self, symbol):
+    '''Returns the number of valence electrons of an element read from its
+    pseudopotential. If the file cannot be read, the number given in
+    ESPRESSO_PPs is used.'''
+
+    try:
+        return self.get_pseudo_info(symbol)['valence']
+    except (IOError, OSError, AttributeError, KeyError):
+        return self.PPs[symbol][1]
+
+Espresso.get_valence = get_valence
@@ -6,4 +6,7 @@ ESPRESSORC = {'executable':'/home-research/zhongnanxu/opt/espresso-5.0.2/bin/pw.
               'PPpath': '/home-research/zhongnanxu/pseudopotentials/gbrv_espresso_pseudo',
               'qsys': 'pbs',
               'mpicmd': 'mpirun',
-              'rundir': '/scratch/${PBS_JOBID}'}  # use ./ as default
+              'rundir': '/scratch/${PBS_JOBID}',  # use ./ as default
+              'pseudo_stage': None,  # e.g. /tmp/${PBS_JOBID}-pseudo
+              'stage_nproc': 8,  # parallel copies when staging files
+              'projwfc': 'projwfc.x'}